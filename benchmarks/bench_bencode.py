@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+""" Bencode decoder benchmark.
+
+    Decodes synthetic small, medium and 100k-file torrents with each
+    decoder, and reports throughput (MB/s) and peak memory. Before that,
+    checks that C{bencode()} and C{bwrite()} agree on a metafile whose
+    pieces are a C{PieceTable}.
+
+    Usage: python benchmarks/bench_bencode.py [repeat]
+"""
+import io
+import os
+import sys
+import time
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from libpth import bencode, metafile # pylint: disable=C0413
+
+
+class RecursiveDecoder(object):
+    """ The previous recursive decoder, kept as the baseline.
+    """
+
+    def __init__(self, data):
+        self.bytes = data
+        self.offset = 0
+
+    def decode(self):
+        data = self.bytes
+        kind = data[self.offset]
+        if 48 <= kind <= 57:
+            end = data.index(b':', self.offset)
+            length = int(data[self.offset:end], 10)
+            self.offset = end + length + 1
+            obj = data[end+1:self.offset]
+        elif kind == 105:
+            end = data.index(b'e', self.offset+1)
+            obj = int(data[self.offset+1:end], 10)
+            self.offset = end + 1
+        elif kind == 108:
+            self.offset += 1
+            obj = []
+            while data[self.offset:self.offset+1] != b'e':
+                obj.append(self.decode())
+            self.offset += 1
+        else:
+            self.offset += 1
+            obj = {}
+            while data[self.offset:self.offset+1] != b'e':
+                key = self.decode().decode('utf8')
+                obj[key] = self.decode()
+            self.offset += 1
+        return obj
+
+
+def make_torrent(num_files, num_pieces, seed=42):
+    """ Return a bencoded synthetic multi-file torrent.
+    """
+    rnd = random.Random(seed)
+    files = [{
+        "length": rnd.randint(1, 2**30),
+        "path": [b"CD%d" % (i // 1000), b"%05d - Track title number %d.flac" % (i, i)],
+    } for i in range(num_files)]
+    return bencode.bencode({
+        "announce": b"https://tracker.example.com/0123456789abcdef/announce",
+        "created by": b"libpth benchmark",
+        "creation date": 1480000000,
+        "info": {
+            "files": files,
+            "name": b"Synthetic Release",
+            "piece length": 2**20,
+            "pieces": rnd.randbytes(20 * num_pieces),
+            "private": 1,
+        },
+    })
+
+
+DECODERS = [
+    ("recursive (baseline)", lambda data: RecursiveDecoder(data).decode()),
+    ("Decoder", bencode.bdecode),
+    ("Decoder (strict)", lambda data: bencode.bdecode(data, strict=True)),
+    ("StreamDecoder", lambda data: bencode.bread(io.BytesIO(data))),
+    ("BencodeView (info.name)", lambda data: bencode.BencodeView(data)["info"]["name"]),
+]
+
+TORRENTS = [
+    ("small (10 files)", 10, 500),
+    ("medium (1k files)", 1000, 20000),
+    ("large (100k files)", 100000, 200000),
+]
+
+
+def check_encoders(data):
+    """ Make sure both encoders produce C{data} again, with the pieces
+        of the decoded metafile wrapped in a C{PieceTable}.
+    """
+    meta = bencode.bdecode(data)
+    meta["info"]["pieces"] = metafile.PieceTable(meta["info"]["pieces"])
+    streamed = io.BytesIO()
+    bencode.bwrite(streamed, meta)
+    for name, encoded in (("bencode", bencode.bencode(meta)), ("bwrite", streamed.getvalue())):
+        if encoded != data:
+            sys.exit("%s() output differs from the original metafile" % name)
+
+
+def measure(decode, data, repeat):
+    """ Return best wall time and peak traced memory for decoding C{data}.
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        decode(data)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    decode(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return best, peak
+
+
+def main():
+    """ Run all benchmarks.
+    """
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for title, num_files, num_pieces in TORRENTS:
+        data = make_torrent(num_files, num_pieces)
+        check_encoders(data)
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+        print("%s, %.1f MiB" % (title, len(data) / 2.0**20))
+        for name, decode in DECODERS:
+            elapsed, peak = measure(decode, data, repeat)
+            print("    %-26s %8.1f MB/s %10.1f MiB peak" % (
+                name, len(data) / elapsed / 1e6, peak / 2.0**20,
+            ))
+
+
+if __name__ == "__main__":
+    main()
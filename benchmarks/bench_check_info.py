@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+""" Info dict validation benchmark.
+
+    Validates synthetic small, medium and 100k-file info dicts with
+    the previous and the current C{check_info}, and reports the time
+    taken for each.
+
+    Usage: python benchmarks/bench_check_info.py [repeat]
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from libpth import metafile # pylint: disable=C0413
+
+
+def baseline_check_info(info):
+    """ The previous validator, checking every path part of every file.
+    """
+    if not isinstance(info, dict):
+        raise ValueError("bad metainfo - not a dictionary")
+
+    pieces = info.get("pieces")
+    if not isinstance(pieces, bytes) or len(pieces) % 20 != 0:
+        raise ValueError("bad metainfo - bad pieces key")
+
+    piece_size = info.get("piece length")
+    if not isinstance(piece_size, int) or piece_size <= 0:
+        raise ValueError("bad metainfo - illegal piece length")
+
+    name = info.get("name")
+    if not isinstance(name, bytes):
+        raise ValueError("bad metainfo - bad name (type is %r)" % type(name).__name__)
+    if not metafile.ALLOWED_ROOT_NAME.match(name.decode('utf8')):
+        raise ValueError("name %s disallowed for security reasons" % name)
+
+    if ("files" in info) == ("length" in info):
+        raise ValueError("single/multiple file mix")
+
+    if "length" in info:
+        length = info.get("length")
+        if not isinstance(length, int) or length < 0:
+            raise ValueError("bad metainfo - bad length")
+    else:
+        files = info.get("files")
+        if not isinstance(files, (list, tuple)):
+            raise ValueError("bad metainfo - bad file list")
+
+        for item in files:
+            if not isinstance(item, dict):
+                raise ValueError("bad metainfo - bad file value")
+
+            length = item.get("length")
+            if not isinstance(length, int) or length < 0:
+                raise ValueError("bad metainfo - bad length")
+
+            path = item.get("path")
+            if not isinstance(path, (list, tuple)) or not path:
+                raise ValueError("bad metainfo - bad path")
+
+            for part in path:
+                if not isinstance(part, bytes):
+                    raise ValueError("bad metainfo - bad path dir")
+                if part == '..':
+                    raise ValueError("relative path in %s disallowed for security reasons" % '/'.join(path))
+                if part and not metafile.ALLOWED_PATH_NAME.match(part.decode('utf8')):
+                    raise ValueError("path %s disallowed for security reasons" % part)
+
+        file_paths = [os.path.join(*[part.decode('utf8') for part in item["path"]]) for item in files]
+        if len(set(file_paths)) != len(file_paths):
+            raise ValueError("bad metainfo - duplicate path")
+
+    return info
+
+
+def make_info(num_files, seed=42):
+    """ Return a synthetic multi-file info dict, with files spread over
+        artist / album / disc directories.
+    """
+    rnd = random.Random(seed)
+    files = [{
+        "length": rnd.randint(1, 2**30),
+        "path": [b"Artist %d" % (i // 5000), b"Album %d" % (i // 500), b"CD%d" % (i // 50),
+                 b"%05d - Track title number %d.flac" % (i, i)],
+    } for i in range(num_files)]
+    return {
+        "files": files,
+        "name": b"Synthetic Release",
+        "piece length": 2**20,
+        "pieces": b"\0" * 20 * (num_files // 2 + 1),
+        "private": 1,
+    }
+
+
+VALIDATORS = [
+    ("check_info (baseline)", baseline_check_info),
+    ("check_info", metafile.check_info),
+    ("info_violations", metafile.info_violations),
+]
+
+SIZES = [
+    ("small (10 files)", 10),
+    ("medium (1k files)", 1000),
+    ("large (100k files)", 100000),
+]
+
+
+def measure(validate, info, repeat):
+    """ Return best wall time for validating C{info}.
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        validate(info)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    """ Run all benchmarks.
+    """
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for title, num_files in SIZES:
+        info = make_info(num_files)
+        print(title)
+        for name, validate in VALIDATORS:
+            elapsed = measure(validate, info, repeat)
+            print("    %-24s %10.2f ms %10.0f files/s" % (name, elapsed * 1000, num_files / elapsed))
+
+
+if __name__ == "__main__":
+    main()
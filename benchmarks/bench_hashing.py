@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+""" Piece hashing benchmark.
+
+    Creates a metafile for a synthetic release with 1 to N hashing
+    workers, and reports throughput and scaling relative to 1 worker.
+    Also reports wall time with a cold and a warm page cache, and the
+    peak Python memory traced while hashing. That's not a count of
+    allocations, which CPython doesn't provide; but it shows whether
+    memory use depends on the amount of data hashed.
+
+    Usage: python benchmarks/bench_hashing.py [size_mib] [max_workers]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from libpth import metafile # pylint: disable=C0413
+
+
+def make_release(root, size, num_files=12):
+    """ Create a release directory with C{num_files} files totalling C{size} bytes.
+    """
+    path = os.path.join(root, "Synthetic Release")
+    os.makedirs(path)
+    block = os.urandom(2**20)
+    for idx in range(num_files):
+        remaining = size // num_files + idx * 4099 # uneven sizes, so pieces span files
+        with open(os.path.join(path, "%02d - Track.flac" % (idx + 1)), "wb") as handle:
+            while remaining > 0:
+                handle.write(block[:remaining])
+                remaining -= len(block)
+    return path
+
+
+def create(path, output, workers):
+    """ Return the seconds needed to create a metafile for C{path}.
+    """
+    started = time.perf_counter()
+    metafile.Metafile(output).create(path, ["http://tracker.example.com/announce"],
+                                     no_date=True, workers=workers)
+    return time.perf_counter() - started
+
+
+def drop_cache(path):
+    """ Evict the files in C{path} from the page cache.
+    """
+    for name in os.listdir(path):
+        with open(os.path.join(path, name), "rb") as handle:
+            # Dirty pages are not dropped, so write them back first
+            os.fsync(handle.fileno())
+            os.posix_fadvise(handle.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def main():
+    """ Run all benchmarks.
+    """
+    size = int(sys.argv[1]) * 2**20 if len(sys.argv) > 1 else 512 * 2**20
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+
+    root = tempfile.mkdtemp(prefix="libpth-bench-")
+    try:
+        path = make_release(root, size)
+        output = os.path.join(root, "bench.torrent")
+        if hasattr(os, "posix_fadvise"):
+            drop_cache(path)
+            print("%d MiB, cold cache: %.2fs" % (size // 2**20, create(path, output, 1)))
+        print("%d MiB, warm cache: %.2fs" % (size // 2**20, create(path, output, 1)))
+
+        tracemalloc.start()
+        create(path, output, 1)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%d MiB, peak traced memory: %.1f MiB" % (size // 2**20, peak / 2.0**20))
+
+        print("%d MiB, warm cache" % (size // 2**20))
+        baseline = None
+        for workers in range(1, max_workers + 1):
+            elapsed = min(create(path, output, workers) for _ in range(2))
+            baseline = baseline or elapsed
+            print("    %2d worker(s) %8.1f MB/s %6.2fx" % (
+                workers, size / elapsed / 1e6, baseline / elapsed,
+            ))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+""" asyncio interface for metafile creation and verification.
+
+    Jobs hash in worker threads, so the event loop is never blocked.
+    A job is awaitable for its result, and asynchronously iterable for
+    throttled progress events:
+
+        job = aiometafile.create("release.torrent", path, [announce_url])
+        async for event in job:
+            print(event.percent, event.eta)
+        meta = await job
+"""
+import os
+import time
+import asyncio
+import weakref
+import threading
+import collections
+
+from . import metafile
+
+
+# Default number of concurrent jobs reading from the same device
+DEVICE_CONCURRENCY = 1
+
+# Semaphores per event loop and device
+_device_semaphores = weakref.WeakKeyDictionary()
+
+
+class Progress(collections.namedtuple("Progress", "bytes total pieces rate eta")):
+    """ A progress event: bytes and pieces done, rate in bytes per second,
+        and estimated seconds remaining (None while unknown).
+    """
+    __slots__ = ()
+
+    @property
+    def percent(self):
+        """ Percentage done.
+        """
+        return self.bytes * 100.0 / self.total if self.total > 0 else 100.0
+
+
+def _device_semaphore(path, concurrency):
+    """ Return the semaphore limiting concurrent jobs on the device of C{path}.
+    """
+    semaphores = _device_semaphores.setdefault(asyncio.get_running_loop(), {})
+    device = os.stat(path).st_dev
+    if device not in semaphores:
+        semaphores[device] = asyncio.Semaphore(concurrency)
+    return semaphores[device]
+
+
+class Job(object):
+    """ A metafile job running in a worker thread.
+
+        Await the job for its result, iterate it with C{async for} to get
+        L{Progress} events, and call C{cancel()} to stop it; cancellation
+        takes effect before the next read, and releases the device only
+        after the worker thread has stopped.
+    """
+
+    def __init__(self, func, datapath, interval=0.5, concurrency=DEVICE_CONCURRENCY):
+        """ Start the job; must be called with a running event loop.
+
+            @param func: Callable doing the work in a thread, called with
+                this job and a progress callback.
+            @param interval: Minimal seconds between progress events.
+            @param concurrency: Concurrent jobs allowed on the same device.
+        """
+        self.datapath = datapath
+        self.interval = interval
+        self.piece_size = None
+        self._func = func
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue()
+        self._cancelled = threading.Event()
+        self._started = None
+        self._last_event = 0.0
+        self._task = asyncio.ensure_future(self._run(concurrency))
+
+
+    def __await__(self):
+        return self._task.__await__()
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        event = await self._events.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+
+    def cancel(self):
+        """ Stop the job.
+        """
+        self._cancelled.set()
+        self._task.cancel()
+
+
+    def done(self):
+        """ Return True if the job has finished.
+        """
+        return self._task.done()
+
+
+    async def _run(self, concurrency):
+        """ Run the job in a worker thread, once the device is free.
+        """
+        try:
+            async with _device_semaphore(self.datapath, concurrency):
+                future = self._loop.run_in_executor(None, self._func, self, self._progress)
+                try:
+                    return await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    # Keep the device busy until the worker thread has stopped
+                    self._cancelled.set()
+                    try:
+                        await future
+                    except BaseException: # pylint: disable=W0703
+                        pass
+                    raise
+        finally:
+            self._events.put_nowait(None)
+
+
+    def _progress(self, done, total):
+        """ Progress callback, called in the worker thread for every read.
+        """
+        if self._cancelled.is_set():
+            raise asyncio.CancelledError()
+
+        now = time.time()
+        if self._started is None:
+            self._started = now
+        if now - self._last_event < self.interval and done < total:
+            return
+        self._last_event = now
+
+        elapsed = now - self._started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        event = Progress(
+            bytes=done,
+            total=total,
+            pieces=done // self.piece_size if self.piece_size else 0,
+            rate=rate,
+            eta=(total - done) / rate if rate and total >= done else None,
+        )
+        self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+
+
+def create(filename, datapath, tracker_urls, interval=0.5, concurrency=DEVICE_CONCURRENCY, **kwargs):
+    """ Create metafile(s) for C{datapath} like C{Metafile.create()},
+        returning a L{Job} whose result is the last metafile dict written.
+    """
+    torrent = metafile.Metafile(filename)
+
+    def run(job, progress):
+        "Worker thread"
+        torrent.datapath = datapath
+        job.piece_size = torrent._piece_size() # pylint: disable=W0212
+        return torrent.create(None, tracker_urls, progress=progress, **kwargs)
+
+    return Job(run, datapath, interval, concurrency)
+
+
+def check(metainfo, datapath, interval=0.5, concurrency=DEVICE_CONCURRENCY, **kwargs):
+    """ Check C{datapath} against C{metainfo} like C{Metafile.check()},
+        returning a L{Job} whose result is a C{metafile.CheckReport}.
+    """
+    torrent = metafile.Metafile(None)
+
+    def run(job, progress):
+        "Worker thread"
+        job.piece_size = int(metainfo["info"]["piece length"])
+        return torrent.check(metainfo, datapath, progress=progress, **kwargs)
+
+    return Job(run, datapath, interval, concurrency)
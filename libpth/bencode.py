@@ -20,88 +20,166 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import io
+import re
+import mmap
+
+
 class BencodeError(ValueError):
     """ Error during decoding or encoding.
     """
 
 
+class NonCanonicalError(BencodeError):
+    """ Valid, but non-canonical bencoded data found in strict mode.
+    """
+
+    def __init__(self, msg, offset):
+        BencodeError.__init__(self, "%s at offset %d" % (msg, offset))
+        self.offset = offset
+
+
+# Canonical integer body, including the trailing 'e'
+CANONICAL_INT = re.compile(br"(?:0|-?[1-9][0-9]*)e")
+
+
 class Decoder(object):
     """ Decode a string or stream to an object.
+
+        Dict keys are delivered as text where they are valid UTF-8, matching
+        the key convention used by C{metafile}.
     """
 
-    def __init__(self, bytes, char_encoding=None):
+    def __init__(self, bytes, char_encoding=None, strict=False):
         """ Initialize encoder.
+
+            @param strict: Raise L{NonCanonicalError} for any data that does
+                not re-encode to the same bytes (unsorted or duplicate keys,
+                leading zeros).
         """
         self.bytes = bytes
         self.offset = 0
         self.char_encoding = char_encoding
+        self.strict = strict
 
 
-    def decode(self, check_trailer=False): # pylint: disable=I0011,R0912
+    def decode(self, check_trailer=False): # pylint: disable=I0011,R0912,R0915
         """ Decode data in C{bytes} and return deserialized object.
 
+            Containers are tracked on an explicit stack, so there is no
+            recursion limit on deeply nested data.
+
             @param check_trailer: Raise error if trailing junk is found in data?
             @raise BencodeError: Invalid data.
         """
-        try:
-            kind = self.bytes[self.offset]
-        except IndexError:
-            raise BencodeError("Unexpected end of data at offset %d/%d" % (
-                self.offset, len(self.bytes),
-            ))
+        data = self.bytes
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        size = len(data)
+        index = data.index
+        strict = self.strict
+        encoding = self.char_encoding
+        offset = self.offset
+
+        # State of the innermost open container (the pending key and the last
+        # raw key are only used for dicts); outer ones are saved on the stack
+        container, is_dict, key, last_key = None, False, None, None
+        stack = []
+        push, pop = stack.append, stack.pop
 
-        if kind.isdigit():
-            # String
+        while True:
             try:
-                end = self.bytes.find(':', self.offset)
-                length = int(self.bytes[self.offset:end], 10)
-            except (ValueError, TypeError):
-                raise BencodeError("Bad string length at offset %d (%r...)" % (
-                    self.offset, self.bytes[self.offset:self.offset+32]
-                ))
+                kind = data[offset]
+            except IndexError:
+                raise BencodeError("Unexpected end of data at offset %d/%d" % (offset, size))
 
-            self.offset = end+length+1
-            obj = self.bytes[end+1:self.offset]
+            if 48 <= kind <= 57:
+                # String
+                try:
+                    colon = index(b':', offset)
+                    length = int(data[offset:colon])
+                except ValueError:
+                    raise BencodeError("Bad string length at offset %d (%r...)" % (
+                        offset, data[offset:offset+32]
+                    ))
+                end = colon + 1 + length
+                if end > size:
+                    raise BencodeError("Unexpected end of data in string at offset %d/%d" % (offset, size))
+                if strict and (kind == 48 and colon - offset > 1 or not data[offset:colon].isdigit()):
+                    raise NonCanonicalError("Non-canonical string length", offset)
 
-            if self.char_encoding:
+                obj = data[colon+1:end]
+                start, offset = offset, end
+
+                if is_dict and key is None:
+                    # Dict key
+                    if strict and last_key is not None and obj <= last_key:
+                        raise NonCanonicalError("%s dict key %r" % (
+                            "Duplicate" if obj == last_key else "Out of order", obj,
+                        ), start)
+                    last_key = obj
+                    try:
+                        key = obj.decode('utf8')
+                    except UnicodeError:
+                        key = obj
+                    continue
+
+                if encoding:
+                    try:
+                        obj = obj.decode(encoding)
+                    except UnicodeError:
+                        # deliver non-decodable string (bytes arrays) as-is
+                        pass
+            elif kind == 101 and container is not None: # 'e'
+                if key is not None:
+                    raise BencodeError("Missing value for key %r at offset %d" % (key, offset))
+                obj = container
+                container, is_dict, key, last_key = pop()
+                offset += 1
+            elif is_dict and key is None:
+                raise BencodeError("Bad dict key at offset %d (%r...)" % (
+                    offset, data[offset:offset+32]
+                ))
+            elif kind == 105: # 'i'
+                # Integer
                 try:
-                    obj = obj.decode(self.char_encoding)
-                except UnicodeError:
-                    # deliver non-decodable string (bytes arrays) as-is
-                    pass
-        elif kind == 'i':
-            # Integer
-            try:
-                end = self.bytes.find('e', self.offset+1)
-                obj = int(self.bytes[self.offset+1:end], 10)
-            except (ValueError, TypeError):
-                raise BencodeError("Bad integer at offset %d (%r...)" % (
-                    self.offset, self.bytes[self.offset:self.offset+32]
+                    end = index(b'e', offset + 1)
+                    obj = int(data[offset+1:end])
+                except ValueError:
+                    raise BencodeError("Bad integer at offset %d (%r...)" % (
+                        offset, data[offset:offset+32]
+                    ))
+                if strict and not CANONICAL_INT.match(data, offset+1, end+1):
+                    raise NonCanonicalError("Non-canonical integer", offset)
+                offset = end + 1
+            elif kind == 108: # 'l'
+                push((container, is_dict, key, last_key))
+                container, is_dict, key, last_key = [], False, None, None
+                offset += 1
+                continue
+            elif kind == 100: # 'd'
+                push((container, is_dict, key, last_key))
+                container, is_dict, key, last_key = {}, True, None, None
+                offset += 1
+                continue
+            else:
+                raise BencodeError("Format error at offset %d (%r...)" % (
+                    offset, data[offset:offset+32]
                 ))
-            self.offset = end+1
-        elif kind == 'l':
-            # List
-            self.offset += 1
-            obj = []
-            while self.bytes[self.offset:self.offset+1] != 'e':
-                obj.append(self.decode())
-            self.offset += 1
-        elif kind == 'd':
-            # Dict
-            self.offset += 1
-            obj = {}
-            while self.bytes[self.offset:self.offset+1] != 'e':
-                key = self.decode()
-                obj[key] = self.decode()
-            self.offset += 1
-        else:
-            raise BencodeError("Format error at offset %d (%r...)" % (
-                self.offset, self.bytes[self.offset:self.offset+32]
-            ))
 
-        if check_trailer and self.offset != len(self.bytes):
+            # Attach finished value to its parent container, if any
+            if container is None:
+                break
+            elif is_dict:
+                container[key] = obj
+                key = None
+            else:
+                container.append(obj)
+
+        self.offset = offset
+        if check_trailer and offset != size:
             raise BencodeError("Trailing data at offset %d (%r...)" % (
-                self.offset, self.bytes[self.offset:self.offset+32]
+                offset, data[offset:offset+32]
             ))
 
         return obj
@@ -127,14 +205,16 @@ class Encoder(object):
             self.result.extend([str(len(obj)).encode('utf8'), b':', obj])
         elif isinstance(obj, bytes):
             self.result.extend([str(len(obj)).encode('utf8'), b':', obj])
+        elif isinstance(obj, (bytearray, memoryview)):
+            # Copy, since the result may be joined after the buffer changed
+            obj = memoryview(obj).tobytes()
+            self.result.extend([str(len(obj)).encode('utf8'), b':', obj])
         elif hasattr(obj, "__bencode__"):
             self.encode(obj.__bencode__())
         elif isinstance(obj, dict):
             # Dictionary
             self.result.append(b'd')
-            for key, val in sorted(obj.items()):
-                if not isinstance(key, bytes):
-                    key = key.encode('utf8')
+            for key, val in _sorted_items(obj):
                 self.result.extend([str(len(key)).encode('utf8'), b':', key])
                 self.encode(val)
             self.result.append(b'e')
@@ -155,10 +235,555 @@ class Encoder(object):
         return self.result
 
 
-def bdecode(bytes, char_encoding=None):
+class StreamEncoder(object):
+    """ Encode objects directly to a writable stream.
+
+        Small tokens are collected in a buffer and written in batches, while
+        strings of at least C{passthrough} bytes (like C{info.pieces}) are
+        handed to the stream as-is, without copying them.
+    """
+
+    def __init__(self, stream, buffer_size=65536, passthrough=4096):
+        """ Initialize encoder.
+
+            @param stream: A file-like object, a socket, or a bytearray.
+        """
+        if hasattr(stream, "write"):
+            self.write = stream.write
+        elif hasattr(stream, "sendall"):
+            self.write = stream.sendall
+        else:
+            self.write = stream.extend
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+        self.passthrough = passthrough
+        self.written = 0
+
+
+    def flush(self):
+        """ Write any batched tokens to the stream.
+        """
+        if self.buffer:
+            self.write(self.buffer)
+            self.written += len(self.buffer)
+            self.buffer = bytearray()
+
+
+    def _string(self, value):
+        """ Add a bytes-like string value.
+        """
+        if not isinstance(value, bytes):
+            value = memoryview(value).cast('B')
+        self.buffer += b"%d:" % len(value)
+
+        if len(value) >= self.passthrough:
+            self.flush()
+            self.write(value)
+            self.written += len(value)
+        else:
+            self.buffer += value
+            if len(self.buffer) >= self.buffer_size:
+                self.flush()
+
+
+    def encode(self, obj):
+        """ Add the given object to the stream; call C{flush()} when done.
+        """
+        if isinstance(obj, (int, bool)):
+            self.buffer += b"i%de" % obj
+        elif isinstance(obj, str):
+            self._string(obj.encode('utf8'))
+        elif isinstance(obj, (bytes, bytearray, memoryview)):
+            self._string(obj)
+        elif hasattr(obj, "__bencode__"):
+            self.encode(obj.__bencode__())
+        elif isinstance(obj, dict):
+            # Dictionary
+            self.buffer += b'd'
+            for key, val in _sorted_items(obj):
+                self._string(key)
+                self.encode(val)
+            self.buffer += b'e'
+        else:
+            # Treat as iterable
+            try:
+                items = iter(obj)
+            except TypeError as exc:
+                raise BencodeError("Unsupported non-iterable object %r of type %s (%s)" % (
+                    obj, type(obj), exc
+                ))
+            else:
+                self.buffer += b'l'
+                for item in items:
+                    self.encode(item)
+                self.buffer += b'e'
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+
+def _sorted_items(obj):
+    """ Return dict items with byte string keys, in bencode key order.
+    """
+    return sorted(((key if isinstance(key, bytes) else key.encode('utf8'), val)
+                   for key, val in obj.items()), key=lambda item: item[0])
+
+
+def encoded_size(obj):
+    """ Return the length of the bencoded form of C{obj}, without encoding it.
+    """
+    if isinstance(obj, (int, bool)):
+        return len(b"%d" % obj) + 2
+    elif isinstance(obj, str):
+        obj = obj.encode('utf8')
+
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        size = memoryview(obj).nbytes
+        return len(str(size)) + 1 + size
+    elif hasattr(obj, "__bencode__"):
+        return encoded_size(obj.__bencode__())
+    elif isinstance(obj, dict):
+        return 2 + sum(encoded_size(key) + encoded_size(val) for key, val in obj.items())
+    else:
+        try:
+            items = iter(obj)
+        except TypeError as exc:
+            raise BencodeError("Unsupported non-iterable object %r of type %s (%s)" % (
+                obj, type(obj), exc
+            ))
+        return 2 + sum(encoded_size(item) for item in items)
+
+
+class StreamDecoder(object):
+    """ Incrementally decode bencoded data that arrives in chunks.
+
+        Feed chunks via C{feed()}, which returns all top-level objects that
+        were completed by that chunk. Input is consumed as soon as a token is
+        complete, so only partial tokens are held in the buffer.
+
+        Dict keys are delivered as text where they are valid UTF-8, matching
+        the key convention used by C{metafile}.
+    """
+
+    def __init__(self, char_encoding=None, max_buffer=None):
+        """ Initialize decoder.
+
+            @param max_buffer: Maximal number of undecoded bytes to hold at once,
+                which also limits the length of a single string value.
+        """
+        self.char_encoding = char_encoding
+        self.max_buffer = max_buffer
+        self.buffer = bytearray()
+        self.consumed = 0
+        self.stack = []
+
+
+    def feed(self, data):
+        """ Add a chunk of data, and return a list of completed objects.
+
+            @raise BencodeError: Invalid data, or memory ceiling exceeded.
+        """
+        self.buffer += data
+        result = []
+        pos = self._parse(result)
+        del self.buffer[:pos]
+        self.consumed += pos
+
+        if self.max_buffer and len(self.buffer) > self.max_buffer:
+            raise BencodeError("Buffer limit of %d bytes exceeded at offset %d" % (
+                self.max_buffer, self.consumed,
+            ))
+
+        return result
+
+
+    def close(self):
+        """ Signal end of input.
+
+            @raise BencodeError: Data ended in the middle of an object.
+        """
+        if self.buffer or self.stack:
+            raise BencodeError("Unexpected end of data at offset %d/%d" % (
+                self.consumed, self.consumed + len(self.buffer),
+            ))
+
+
+    def _error(self, msg, pos):
+        """ Raise a decoding error for the given buffer position.
+        """
+        raise BencodeError("%s at offset %d (%r...)" % (
+            msg, self.consumed + pos, bytes(self.buffer[pos:pos+32]),
+        ))
+
+
+    def _parse(self, result): # pylint: disable=I0011,R0912
+        """ Consume complete tokens from the buffer, appending finished
+            top-level objects to C{result}; return the consumed length.
+        """
+        buf = self.buffer
+        stack = self.stack
+        end = len(buf)
+        pos = 0
+
+        while pos < end:
+            kind = buf[pos]
+            if 48 <= kind <= 57:
+                # String
+                colon = buf.find(b':', pos, pos + 21)
+                if colon < 0:
+                    if end - pos > 20:
+                        self._error("Bad string length", pos)
+                    break
+                try:
+                    length = int(buf[pos:colon], 10)
+                except ValueError:
+                    self._error("Bad string length", pos)
+
+                tail = colon + 1 + length
+                if tail > end:
+                    if self.max_buffer and tail - pos > self.max_buffer:
+                        self._error("String of %d bytes exceeds buffer limit" % length, pos)
+                    break
+                obj = bytes(buf[colon+1:tail])
+                pos = tail
+
+                if self.char_encoding:
+                    try:
+                        obj = obj.decode(self.char_encoding)
+                    except UnicodeError:
+                        # deliver non-decodable string (bytes arrays) as-is
+                        pass
+            elif kind == 105: # 'i'
+                tail = buf.find(b'e', pos + 1)
+                if tail < 0:
+                    break
+                try:
+                    obj = int(buf[pos+1:tail], 10)
+                except ValueError:
+                    self._error("Bad integer", pos)
+                pos = tail + 1
+            elif kind == 108: # 'l'
+                stack.append([[], None])
+                pos += 1
+                continue
+            elif kind == 100: # 'd'
+                stack.append([{}, None])
+                pos += 1
+                continue
+            elif kind == 101 and stack: # 'e'
+                obj, key = stack.pop()
+                if key is not None:
+                    self._error("Missing value for key %r" % (key,), pos)
+                pos += 1
+            else:
+                self._error("Format error", pos)
+
+            # Attach finished value to its parent container, if any
+            if not stack:
+                result.append(obj)
+            else:
+                top = stack[-1]
+                if isinstance(top[0], list):
+                    top[0].append(obj)
+                elif top[1] is None:
+                    if isinstance(obj, (list, dict, int)):
+                        self._error("Bad dict key", pos)
+                    if isinstance(obj, bytes):
+                        try:
+                            obj = obj.decode('utf8')
+                        except UnicodeError:
+                            pass
+                    top[1] = obj
+                else:
+                    top[0][top[1]] = obj
+                    top[1] = None
+
+        return pos
+
+
+def _scan(data, offset):
+    """ Return the end offset of the value starting at C{offset} in C{data},
+        without decoding it.
+    """
+    size = len(data)
+    find = getattr(data, "find", None)
+    depth = 0
+    start = offset
+    try:
+        while True:
+            kind = data[offset]
+            if 48 <= kind <= 57:
+                # String
+                if find:
+                    colon = find(b':', offset, offset + 21)
+                    if colon < 0:
+                        raise ValueError
+                else:
+                    colon = offset + 1
+                    while data[colon] != 58:
+                        colon += 1
+                        if colon - offset > 20:
+                            raise ValueError
+                offset = colon + 1 + int(data[offset:colon])
+                if offset > size:
+                    raise IndexError
+            elif kind == 105: # 'i'
+                if find:
+                    offset = find(b'e', offset + 1)
+                    if offset < 0:
+                        raise IndexError
+                else:
+                    offset += 1
+                    while data[offset] != 101:
+                        offset += 1
+                offset += 1
+            elif kind == 108 or kind == 100: # 'l', 'd'
+                depth += 1
+                offset += 1
+                continue
+            elif kind == 101 and depth: # 'e'
+                depth -= 1
+                offset += 1
+            else:
+                raise ValueError
+
+            if not depth:
+                return offset
+    except IndexError:
+        raise BencodeError("Unexpected end of data in value at offset %d/%d" % (start, size))
+    except ValueError:
+        raise BencodeError("Format error at offset %d (%r...)" % (
+            offset, bytes(data[offset:offset+32])
+        ))
+
+
+class BencodeView(object):
+    """ Lazy, read-only view of a bencoded value inside a buffer.
+
+        The underlying C{bytes}, C{memoryview} or C{mmap} object is never
+        copied. Containers are indexed on access, only as far as needed to
+        find the requested child, scalars are decoded when accessed, and
+        C{raw} / C{span()} expose the original bytes of any sub-value
+        (e.g. to hash the C{info} dict as-is).
+    """
+
+    def __init__(self, data, start=0, end=None, char_encoding=None):
+        """ Initialize view of the value at offset C{start}.
+        """
+        if isinstance(data, memoryview):
+            self.data = self._buffer = data
+        else:
+            # Keep the original object around for its (much faster) find()
+            self.data = memoryview(data)
+            self._buffer = data
+        self.start = start
+        self._end = end
+        self.char_encoding = char_encoding
+        self._index = None
+        self._offset = None
+        self._pending = None
+
+
+    @property
+    def end(self):
+        """ End offset of the viewed value (determined on first use).
+        """
+        if self._end is None:
+            self._end = _scan(self._buffer, self.start)
+        return self._end
+
+
+    def __repr__(self):
+        return "<%s %s [%d:%d]>" % (self.__class__.__name__, self.kind, self.start, self.end)
+
+
+    @property
+    def kind(self):
+        """ Type of the viewed value (dict, list, int or bytes).
+        """
+        return {100: 'dict', 108: 'list', 105: 'int'}.get(self.data[self.start], 'bytes')
+
+
+    @property
+    def raw(self):
+        """ The original bencoded bytes of this value, as a memoryview.
+        """
+        return self.data[self.start:self.end]
+
+
+    def _get_index(self, wanted=None):
+        """ Index the direct children of this container, up to the child
+            with key or position C{wanted}, or all of them if it's None.
+
+            Spans in the index may have an end of None, for the last child
+            found so far; its end is determined when indexing continues.
+        """
+        if self._index is None:
+            kind = self.kind
+            if kind not in ('dict', 'list'):
+                raise TypeError("Cannot index a bencoded %s" % kind)
+            self._index = {} if kind == 'dict' else []
+            self._offset = self.start + 1
+
+        index = self._index
+        is_dict = isinstance(index, dict)
+        if wanted is not None and not is_dict and wanted < 0:
+            # Counting from the end needs all children
+            wanted = None
+        data = self.data
+        size = len(data)
+        while self._offset is not None:
+            if wanted is not None and (wanted in index if is_dict else wanted < len(index)):
+                break
+
+            if self._pending is not None:
+                key, value_start = self._pending
+                self._offset = _scan(self._buffer, value_start)
+                index[key] = (value_start, self._offset)
+                self._pending = None
+
+            offset = self._offset
+            if offset >= size:
+                raise BencodeError("Unexpected end of data in value at offset %d/%d" % (self.start, size))
+            if data[offset] == 101: # 'e'
+                if self._end is None:
+                    self._end = offset + 1
+                self._offset = None
+                break
+
+            if is_dict:
+                value_start = _scan(self._buffer, offset)
+                if value_start >= size:
+                    raise BencodeError("Unexpected end of data in value at offset %d/%d" % (self.start, size))
+                key = self._decode(offset, value_start, key=True)
+                index[key] = (value_start, None)
+            else:
+                value_start = offset
+                key = len(index)
+                index.append((value_start, None))
+            self._pending = (key, value_start)
+
+        return index
+
+
+    def _span(self, key):
+        """ Return C{(start, end)} offsets of the given child value, where
+            C{end} may still be None.
+        """
+        if isinstance(key, bytes) and self.kind == 'dict':
+            try:
+                key = key.decode('utf8')
+            except UnicodeError:
+                pass
+        return self._get_index(key)[key]
+
+
+    def _decode(self, start, end, key=False):
+        """ Decode the scalar at the given span.
+        """
+        data = self.data
+        if data[start] == 105: # 'i'
+            return int(data[start+1:end-1])
+
+        colon = start + 1
+        while data[colon] != 58:
+            colon += 1
+        obj = bytes(data[colon+1:end])
+
+        encoding = 'utf8' if key and not self.char_encoding else self.char_encoding
+        if encoding:
+            try:
+                obj = obj.decode(encoding)
+            except UnicodeError:
+                pass
+        return obj
+
+
+    def span(self, key):
+        """ Return C{(start, end)} offsets of the given child value.
+        """
+        start, end = self._span(key)
+        if end is None:
+            end = _scan(self._buffer, start)
+        return start, end
+
+
+    def view(self, key):
+        """ Return a view of the given child value.
+        """
+        start, end = self._span(key)
+        return self._child(start, end)
+
+
+    def _child(self, start, end):
+        """ Return a view of the value at the given span.
+        """
+        child = BencodeView(self.data, start, end, self.char_encoding)
+        child._buffer = self._buffer # pylint: disable=W0212
+        return child
+
+
+    def __getitem__(self, key):
+        """ Return the given child; containers are returned as views,
+            scalars are decoded.
+        """
+        start, end = self._span(key)
+        if self.data[start] in (100, 108):
+            return self._child(start, end)
+        if end is None:
+            end = _scan(self._buffer, start)
+        return self._decode(start, end)
+
+
+    def get(self, key, default=None):
+        """ Return the given child, or C{default} if it's missing.
+        """
+        try:
+            return self[key]
+        except (KeyError, IndexError):
+            return default
+
+
+    def keys(self):
+        """ Return the keys of a dict view.
+        """
+        return self._get_index().keys()
+
+
+    def __contains__(self, key):
+        try:
+            self._span(key)
+        except (KeyError, IndexError):
+            return False
+        return True
+
+
+    def __len__(self):
+        return len(self._get_index())
+
+
+    def __iter__(self):
+        if self.kind == 'dict':
+            return iter(self._get_index())
+        return (self[i] for i in range(len(self)))
+
+
+    def value(self):
+        """ Fully decode the viewed value.
+        """
+        kind = self.kind
+        if kind == 'dict':
+            return dict((key, self.view(key).value()) for key in self.keys())
+        elif kind == 'list':
+            return [self.view(i).value() for i in range(len(self))]
+        else:
+            return self._decode(self.start, self.end)
+
+
+def bdecode(bytes, char_encoding=None, strict=False):
     """ Decode a string or stream to an object.
     """
-    return Decoder(bytes, char_encoding).decode(check_trailer=True)
+    return Decoder(bytes, char_encoding, strict).decode(check_trailer=True)
 
 
 def bencode(obj):
@@ -167,27 +792,115 @@ def bencode(obj):
     return b''.join(Encoder().encode(obj))
 
 
-def bread(stream):
-    """ Decode a file or stream to an object.
+def splice(data, changes):
+    """ Return the bencoded dict in C{data} with some of its keys changed.
+
+        Only the new values are encoded, all other keys and values (like a
+        metafile's C{info} dict) are copied byte for byte, without decoding
+        them. A value of None removes the key.
+
+        @param changes: Dict of top-level keys and their new values.
     """
-    if hasattr(stream, "read"):
-        return bdecode(stream.read())
-    else:
-        handle = open(stream, "rb")
+    view = memoryview(data)
+    if not view.nbytes or view[0] != 100: # 'd'
+        raise BencodeError("Not a bencoded dict")
+
+    # Find the key and value spans of the existing items
+    items = []
+    offset = 1
+    while True:
         try:
-            return bdecode(handle.read())
-        finally:
+            if view[offset] == 101: # 'e'
+                break
+        except IndexError:
+            raise BencodeError("Unexpected end of data in dict")
+        key_end = _scan(data, offset)
+        end = _scan(data, key_end)
+        colon = bytes(view[offset:key_end]).index(b':')
+        items.append((bytes(view[offset+colon+1:key_end]), offset, end))
+        offset = end
+    if offset + 1 != view.nbytes:
+        raise BencodeError("Extra data at end of dict (offset %d/%d)" % (offset + 1, view.nbytes))
+
+    # Merge changes into the existing items, in key order
+    changes = dict(_sorted_items(changes))
+    existing = set(key for key, _, _ in items)
+    items.extend((key, None, None) for key in changes if key not in existing)
+    items.sort(key=lambda item: item[0])
+
+    result = [b'd']
+    for key, start, end in items:
+        if key in changes:
+            if changes[key] is not None:
+                result.append(b"%d:%s" % (len(key), key))
+                result.extend(Encoder().encode(changes[key]))
+        else:
+            result.append(view[start:end])
+    result.append(b'e')
+    return b''.join(result)
+
+
+def iterdecode(stream, char_encoding=None, chunk_size=65536, max_buffer=None):
+    """ Decode a file or stream chunk-wise, yielding each top-level object.
+    """
+    decoder = StreamDecoder(char_encoding, max_buffer)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        for obj in decoder.feed(chunk):
+            yield obj
+    decoder.close()
+
+
+def bread(stream, char_encoding=None, max_buffer=None):
+    """ Decode a file or stream to an object.
+    """
+    handle = None
+    if not hasattr(stream, "read"):
+        stream = handle = open(stream, "rb")
+    try:
+        result = list(iterdecode(stream, char_encoding, max_buffer=max_buffer))
+    finally:
+        if handle:
             handle.close()
 
+    if len(result) != 1:
+        raise BencodeError("Expected exactly one object in stream, found %d" % len(result))
+    return result[0]
+
 
 def bwrite(stream, obj):
     """ Encode a given object to a file or stream.
     """
     handle = None
-    if not hasattr(stream, "write"):
+    if not hasattr(stream, "write") and not hasattr(stream, "sendall"):
         stream = handle = open(stream, "wb")
     try:
-        stream.write(bencode(obj))
+        encoder = StreamEncoder(stream)
+        encoder.encode(obj)
+        encoder.flush()
     finally:
         if handle:
             handle.close()
+
+
+def bview(stream, char_encoding=None):
+    """ Return a lazy view of a file or stream, memory-mapping regular files.
+    """
+    handle = None
+    if not hasattr(stream, "read"):
+        stream = handle = open(stream, "rb")
+    try:
+        try:
+            data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            # Not a regular (or non-empty) file
+            data = stream.read()
+    finally:
+        if handle:
+            handle.close()
+
+    if not len(data):
+        raise BencodeError("Unexpected end of data at offset 0/0")
+    return BencodeView(data, char_encoding=char_encoding)
@@ -0,0 +1,243 @@
+""" Cross-seed matching.
+
+    Find out which existing metafiles a data directory can seed, even
+    after files were renamed. Torrents are indexed by their multiset of
+    file lengths, candidates are narrowed down by sizes alone, and a
+    match is confirmed by hashing a few sampled pieces only.
+"""
+import os
+import hashlib
+import collections
+import concurrent.futures
+
+from . import metafile
+
+
+class IndexedTorrent(collections.namedtuple("IndexedTorrent", "filename name total_size lengths_key largest lengths")):
+    """ Summary of a metafile in a L{TorrentIndex}; C{lengths} is the
+        C{Counter} of its non-empty file lengths.
+    """
+    __slots__ = ()
+
+
+class Match(collections.namedtuple("Match", "torrent datapath paths report")):
+    """ A confirmed match of a metafile against data on disk; C{paths}
+        are the matched files, in metainfo order.
+    """
+    __slots__ = ()
+
+
+def lengths_key(lengths):
+    """ Return a compact key for the multiset of the given file lengths
+        (empty files are ignored, since they carry no data).
+    """
+    return hashlib.sha1(repr(sorted(i for i in lengths if i)).encode('ascii')).digest()
+
+
+def torrent_files(info):
+    """ Return C{(relative path, length)} for the files of an info dict,
+        without BEP 47 padding files.
+    """
+    if "length" in info:
+        return [(info["name"].decode('utf8', 'replace'), info["length"])]
+    return [(os.path.join(*[part.decode('utf8', 'replace') for part in item["path"]]), item["length"])
+            for item in info["files"] if not metafile.is_padding(item)]
+
+
+def map_files(files, entries, root):
+    """ Map torrent files to the given L{metafile.InventoryEntry} list by size,
+        preferring the same relative path, then the same file name.
+
+        Returns a list of paths in C{files} order, or None if some file
+        has no counterpart of the same size.
+    """
+    by_path = {}
+    by_size = collections.defaultdict(list)
+    for entry in entries:
+        by_path[os.path.relpath(entry.path, root)] = entry
+        by_size[entry.size].append(entry)
+
+    used = set()
+    paths = [None] * len(files)
+
+    # Same path and size
+    for idx, (relpath, length) in enumerate(files):
+        entry = by_path.get(relpath)
+        if entry is not None and entry.size == length and entry.path not in used:
+            paths[idx] = entry.path
+            used.add(entry.path)
+
+    # Renamed files: same size, preferably same name
+    for idx, (relpath, length) in enumerate(files):
+        if paths[idx] is not None:
+            continue
+        if not length:
+            # Empty files carry no data
+            paths[idx] = os.devnull
+            continue
+
+        candidates = [i for i in by_size.get(length, ()) if i.path not in used]
+        if not candidates:
+            return None
+        basename = os.path.basename(relpath)
+        entry = next((i for i in candidates if os.path.basename(i.path) == basename), candidates[0])
+        paths[idx] = entry.path
+        used.add(entry.path)
+
+    return paths
+
+
+def sample_pieces(info, samples):
+    """ Choose up to C{samples} pieces worth hashing to confirm a match.
+
+        These are the first pieces of files spread evenly over the torrent
+        (which catches re-tagged audio files of unchanged size), plus the
+        last piece.
+    """
+    piece_size = info["piece length"]
+    offset, starts = 0, []
+    for item in info.get("files", [info]):
+        if item["length"] and not metafile.is_padding(item):
+            starts.append(offset // piece_size)
+        offset += item["length"]
+    if not starts:
+        return []
+
+    starts = sorted(set(starts))
+    step = max(1, len(starts) / float(max(1, samples - 1)))
+    chosen = set(starts[int(i * step)] for i in range(min(len(starts), max(1, samples - 1))))
+    chosen.add((offset - 1) // piece_size)
+    return sorted(chosen)
+
+
+def summarize(filename):
+    """ Read a metafile, and return its L{IndexedTorrent} summary.
+
+        Metafiles are validated like in L{TorrentIndex.match}, so that
+        ones which could never be matched are not indexed.
+    """
+    info = metafile.checked_open(filename)["info"]
+    lengths = [length for _, length in torrent_files(info)]
+    return IndexedTorrent(filename, info["name"], sum(lengths), lengths_key(lengths), max(lengths or [0]),
+                          collections.Counter(i for i in lengths if i))
+
+
+def _summarize_safely(filename):
+    """ Return the summary of a metafile, or the exception raised reading it.
+    """
+    try:
+        return summarize(filename)
+    except (EnvironmentError, ValueError, KeyError, TypeError, AttributeError) as exc:
+        return exc
+
+
+class TorrentIndex(object):
+    """ An index of metafiles by total size and multiset of file lengths.
+    """
+
+    def __init__(self):
+        """ Initialize empty index.
+        """
+        self.torrents = []
+        self.errors = []
+        self._by_lengths = collections.defaultdict(list)
+        self._by_largest = collections.defaultdict(list)
+
+
+    def __len__(self):
+        return len(self.torrents)
+
+
+    def add(self, filename):
+        """ Add a metafile to the index.
+        """
+        return self._add(summarize(filename))
+
+
+    def _add(self, torrent):
+        """ Add an L{IndexedTorrent}.
+        """
+        self.torrents.append(torrent)
+        self._by_lengths[torrent.lengths_key].append(torrent)
+        self._by_largest[torrent.largest].append(torrent)
+        return torrent
+
+
+    def add_dir(self, path, workers=1):
+        """ Add all C{*.torrent} files in the given directory tree, reading
+            them in C{workers} processes; files that cannot be read are
+            collected in C{errors}.
+        """
+        filenames = [os.path.join(dirpath, filename)
+                     for dirpath, _, filenames in os.walk(path)
+                     for filename in filenames if filename.endswith(".torrent")]
+
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(_summarize_safely, filenames, chunksize=256))
+        else:
+            results = [_summarize_safely(filename) for filename in filenames]
+
+        for filename, result in zip(filenames, results):
+            if isinstance(result, IndexedTorrent):
+                self._add(result)
+            else:
+                self.errors.append((filename, result))
+
+
+    def candidates(self, lengths, partial=False):
+        """ Return indexed torrents whose file lengths equal the given ones,
+            or (with C{partial}) are contained in them.
+        """
+        result = list(self._by_lengths.get(lengths_key(lengths), ()))
+        if partial:
+            available = collections.Counter(i for i in lengths if i)
+            total_size = sum(lengths)
+            seen = set(i.filename for i in result)
+            for largest in set(available):
+                for torrent in self._by_largest.get(largest, ()):
+                    if torrent.filename in seen or torrent.total_size > total_size:
+                        continue
+                    if not torrent.lengths - available:
+                        result.append(torrent)
+                        seen.add(torrent.filename)
+        return result
+
+
+    def match(self, datapath, samples=3, partial=False, workers=1):
+        """ Return a L{Match} for every indexed torrent that C{datapath} can seed.
+
+            @param samples: Number of pieces hashed to confirm a candidate.
+            @param partial: Also match torrents covering a subset of the files.
+        """
+        datapath = datapath.rstrip(os.sep)
+        scanner = metafile.Metafile(None, datapath)
+        entries = scanner.inventory()
+        root = datapath if os.path.isdir(datapath) else os.path.dirname(datapath)
+
+        matches = []
+        for torrent in self.candidates([entry.size for entry in entries], partial):
+            try:
+                meta = metafile.checked_open(torrent.filename)
+            except (EnvironmentError, ValueError) as exc:
+                self.errors.append((torrent.filename, exc))
+                continue
+            paths = map_files(torrent_files(meta["info"]), entries, root)
+            if paths is None:
+                continue
+
+            report = metafile.Metafile(None).check(meta, root, workers=workers, fail_fast=True,
+                                                   sample=sample_pieces(meta["info"], samples), paths=paths)
+            if report:
+                matches.append(Match(torrent, datapath, paths, report))
+
+        return matches
+
+
+    def match_library(self, library, samples=3, partial=False, workers=1):
+        """ Match every entry (release directory or single file) directly
+            inside C{library}, and yield all L{Match}es found.
+        """
+        for name in sorted(os.listdir(library)):
+            for found in self.match(os.path.join(library, name), samples, partial, workers):
+                yield found
@@ -0,0 +1,126 @@
+""" In-place editing of metafiles.
+
+    Top-level keys like C{announce} or C{comment} are changed by splicing
+    the original bytes, so the C{info} dict is never decoded or encoded
+    again, and the info hash cannot change. For passkey rotation:
+
+        metaedit.edit_dir(path, {"announce": lambda url: url.replace(b"old", b"new")}, workers=8)
+"""
+import os
+import stat
+import time
+import tempfile
+import collections
+import concurrent.futures
+
+from . import bencode
+
+
+class EditReport(collections.namedtuple("EditReport", "edited unchanged errors elapsed")):
+    """ Result of editing a directory of metafiles; C{errors} is a list of
+        C{(filename, exception)} pairs.
+    """
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """ Processed metafiles per second.
+        """
+        return (self.edited + self.unchanged) / self.elapsed if self.elapsed else 0.0
+
+
+def edit(data, changes):
+    """ Return bencoded metafile C{data} with changed top-level keys.
+
+        @param changes: Dict of keys and new values; None removes a key,
+            and a callable is called with the current value (or None)
+            to get the new one. Strings are passed to callables as
+            C{bytes}, so they must return C{bytes} too.
+    """
+    if "info" in changes or b"info" in changes:
+        raise ValueError("the info dict cannot be changed without changing the info hash")
+
+    view = None
+    resolved = {}
+    for key, value in changes.items():
+        if callable(value):
+            if view is None:
+                # Scanning to the end rejects broken data before any callable sees it
+                view = bencode.BencodeView(data)
+                view.end # pylint: disable=W0104
+            current = view.get(key)
+            if isinstance(current, bencode.BencodeView):
+                current = current.value()
+            value = value(current)
+        resolved[key] = value
+
+    return bencode.splice(data, resolved)
+
+
+def _atomic_write(filename, data, fsync=True):
+    """ Replace a file by a completely written new version.
+    """
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    handle, tmpname = tempfile.mkstemp(prefix="." + basename + ".", suffix=".tmp", dir=dirname)
+    try:
+        with os.fdopen(handle, "wb") as output:
+            output.write(data)
+            if fsync:
+                output.flush()
+                os.fsync(output.fileno())
+        os.chmod(tmpname, stat.S_IMODE(os.stat(filename).st_mode))
+        os.replace(tmpname, filename)
+    except BaseException:
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        raise
+
+
+def edit_file(filename, changes, fsync=True):
+    """ Edit a metafile in place, see L{edit}; it's replaced atomically,
+        and only if its content actually changes.
+
+        @return: True if the file was changed.
+    """
+    with open(filename, "rb") as handle:
+        data = handle.read()
+
+    result = edit(data, changes)
+    if result == data:
+        return False
+
+    _atomic_write(filename, result, fsync)
+    return True
+
+
+def edit_dir(path, changes, workers=4, fsync=True):
+    """ Edit all C{*.torrent} files in the given directory tree in place,
+        using C{workers} threads, and return an L{EditReport}. Any error
+        (including one raised by a callable in C{changes}) only fails the
+        file it occurs in.
+    """
+    started = time.time()
+    filenames = [os.path.join(dirpath, filename)
+                 for dirpath, _, filenames in os.walk(path)
+                 for filename in filenames if filename.endswith(".torrent")]
+
+    def edit_safely(filename):
+        "Worker"
+        try:
+            return edit_file(filename, changes, fsync)
+        except Exception as exc: # pylint: disable=W0703
+            return exc
+
+    edited, unchanged, errors = 0, 0, []
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as pool:
+        for filename, result in zip(filenames, pool.map(edit_safely, filenames)):
+            if result is True:
+                edited += 1
+            elif result is False:
+                unchanged += 1
+            else:
+                errors.append((filename, result))
+
+    return EditReport(edited, unchanged, errors, time.time() - started)
@@ -22,16 +22,27 @@ import sys
 import time
 import stat
 import math
+import json
+import zlib
 import errno
 import pprint
+import random
 import fnmatch
 import hashlib
 import os.path
+import threading
+import collections
 import urllib.parse
-from contextlib import closing
+import concurrent.futures
+from contextlib import closing, contextmanager
 
 from . import bencode
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 # Allowed characters in a metafile filename or path
 ALLOWED_ROOT_NAME = re.compile(r"^[^/\\.~][^/\\]*$") # cannot be absolute or ~user, and cannot have path parts
@@ -61,12 +72,65 @@ METAFILE_STD_KEYS = [i.split('.') for i in (
     "info.files",
     "info.files.length",
     "info.files.path",
+    "info.files.attr", # BEP-0047
+    "info.meta version", # BEP-0052
+    "info.file tree",
+    "piece layers",
 )]
 
 
-def console_progress():
+class _CRC32(object):
+    """ CRC32 checksum, with the C{hashlib} interface.
+    """
+
+    def __init__(self):
+        """ Initialize checksum.
+        """
+        self.value = 0
+
+    def update(self, data):
+        """ Add C{data} to the checksum.
+        """
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        """ Return the checksum as 8 hex digits.
+        """
+        return "%08x" % self.value
+
+
+# Size of the merkle tree leaf blocks of BitTorrent v2 (BEP 52)
+V2_BLOCK_SIZE = 16384
+
+# Per-file digests that can be computed while hashing pieces
+FILE_DIGESTS = {
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+    "crc32": _CRC32,
+}
+
+# Manifest file extensions, for each per-file digest
+MANIFEST_EXTENSIONS = {
+    "md5": ".md5",
+    "sha1": ".sha1",
+    "sha256": ".sha256",
+    "crc32": ".sfv",
+}
+
+
+def format_manifest(digest_name, file_digests):
+    """ Return the text of a checksum manifest (C{.sfv} for "crc32",
+        else in md5sum format) for C{(relative path, digests)} pairs.
+    """
+    if digest_name == "crc32":
+        return "".join("%s %s\n" % (path, digests["crc32"].upper()) for path, digests in file_digests)
+    return "".join("%s  %s\n" % (digests[digest_name], path) for path, digests in file_digests)
+
+
+def console_progress(interval=0.2):
     """ Return a progress indicator for consoles if
-        stdout is a tty.
+        stdout is a tty, updated at most every C{interval} seconds.
     """
     def progress(totalhashed, totalsize):
         msg = " " * 30
@@ -76,11 +140,28 @@ def console_progress():
         sys.stdout.flush()
 
     try:
-        return progress if sys.stdout.isatty() else None
+        return throttled_progress(progress, interval) if sys.stdout.isatty() else None
     except AttributeError:
         return None
 
 
+def throttled_progress(progress, interval):
+    """ Wrap a progress callback, so that it's called at most every
+        C{interval} seconds; the final call (all done) is always passed on.
+    """
+    last_call = [0.0]
+
+    def throttled(done, total):
+        "Rate-limited callback"
+        now = time.time()
+        if done < total and now - last_call[0] < interval:
+            return
+        last_call[0] = now
+        progress(done, total)
+
+    return throttled
+
+
 def mask_keys(announce_url):
     """ Mask any passkeys (hex sequences) in an announce URL.
     """
@@ -101,65 +182,564 @@ class MaskingPrettyPrinter(pprint.PrettyPrinter):
         return pprint.PrettyPrinter.format(self, obj, context, maxlevels, level)
 
 
+class PieceTable(object):
+    """ The piece hashes of a metafile, kept in one contiguous buffer.
+
+        Wrapping C{info["pieces"]} does not copy it, and neither does
+        slicing; single hashes are returned as C{bytes}. A table created
+        from a C{bytearray} can be appended to.
+    """
+
+    HASH_SIZE = 20
+
+
+    def __init__(self, data=b""):
+        """ Initialize table from concatenated piece hashes.
+        """
+        if memoryview(data).nbytes % self.HASH_SIZE:
+            raise ValueError("bad piece hashes - length %d is not a multiple of %d" % (
+                memoryview(data).nbytes, self.HASH_SIZE))
+        self.data = data
+
+
+    @property
+    def view(self):
+        """ Byte-wise memoryview of the hashes.
+        """
+        return memoryview(self.data).cast('B')
+
+
+    def __len__(self):
+        return memoryview(self.data).nbytes // self.HASH_SIZE
+
+
+    def __getitem__(self, index):
+        """ Return a single hash, or a table sharing this table's buffer.
+        """
+        size = self.HASH_SIZE
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("piece table slices cannot have a step")
+            return PieceTable(self.view[start * size:max(start, stop) * size])
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("piece index %d out of range" % index)
+        return bytes(self.view[index * size:(index + 1) * size])
+
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+    def __eq__(self, other):
+        if isinstance(other, PieceTable):
+            other = other.view
+        return self.view == other
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __bytes__(self):
+        return self.view.tobytes()
+
+
+    def __bencode__(self):
+        return self.view
+
+
+    def append(self, digest):
+        """ Add a piece hash to a C{bytearray} backed table.
+        """
+        if len(digest) != self.HASH_SIZE:
+            raise ValueError("bad piece hash of length %d" % len(digest))
+        self.data += digest
+
+
+    def for_range(self, offset, length, piece_size):
+        """ Return the pieces covering the given byte range of the torrent data.
+        """
+        if length <= 0:
+            return self[0:0]
+        return self[offset // piece_size:(offset + length - 1) // piece_size + 1]
+
+
+    def as_array(self):
+        """ Return a C{(n, 20)} NumPy uint8 view of the hashes.
+        """
+        if numpy is None:
+            raise RuntimeError("NumPy is not installed")
+        return numpy.frombuffer(self.view, dtype=numpy.uint8).reshape(-1, self.HASH_SIZE)
+
+
+    def mismatches(self, other, block=4096):
+        """ Return the indices of pieces that differ from C{other}.
+
+            Pieces present in only one of both tables count as mismatches.
+        """
+        if not isinstance(other, PieceTable):
+            other = PieceTable(other)
+        common = min(len(self), len(other))
+        result = []
+
+        if numpy is not None:
+            result = numpy.flatnonzero(
+                (self[:common].as_array() != other[:common].as_array()).any(axis=1)
+            ).tolist()
+        else:
+            # Skip over equal blocks of hashes, and only compare pieces within differing ones
+            mine, theirs = self.view, other.view
+            size = self.HASH_SIZE
+            for first in range(0, common, block):
+                last = min(first + block, common)
+                if mine[first * size:last * size] != theirs[first * size:last * size]:
+                    result.extend(idx for idx in range(first, last)
+                                  if mine[idx * size:(idx + 1) * size] != theirs[idx * size:(idx + 1) * size])
+
+        result.extend(range(common, max(len(self), len(other))))
+        return result
+
+
+def piece_segments(sizes, piece_size):
+    """ Yield, for each piece of the concatenated files with the given sizes,
+        a list of C{(file index, file offset, length)} segments.
+    """
+    segments = []
+    done = 0
+    for idx, size in enumerate(sizes):
+        offset = 0
+        while offset < size:
+            length = min(size - offset, piece_size - done)
+            segments.append((idx, offset, length))
+            offset += length
+            done += length
+            if done == piece_size:
+                yield segments
+                segments = []
+                done = 0
+
+    # Partial last piece
+    if segments:
+        yield segments
+
+
+def hash_pieces(pieces, workers=1, pool=None, stats=None):
+    """ Hash C{(key, data)} pairs, and yield C{(key, digest)} in the same order.
+
+        With more than one worker, pieces are hashed on a thread pool
+        (SHA1 releases the GIL), while the next ones are being read.
+        At most C{2 * workers} pieces are in flight, so a reader can
+        safely reuse one more buffer than that.
+
+        @param pool: An executor shared with other jobs, used instead
+            of a private pool of C{workers} threads.
+        @param stats: A L{HashStats} object collecting hashing times.
+    """
+    digest = _sha1_digest if stats is None else stats.sha1_digest
+    if workers <= 1:
+        for key, data in pieces:
+            yield key, digest(data)
+        return
+
+    if pool is None:
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            for item in hash_pieces(pieces, workers, pool, stats):
+                yield item
+        return
+
+    # Keep a bounded number of pieces in flight, so memory use stays flat
+    pending = collections.deque()
+    try:
+        for key, data in pieces:
+            pending.append((key, pool.submit(digest, data)))
+            if len(pending) >= 2 * workers:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+    finally:
+        # Don't let a shared pool hash into buffers that are being reused
+        concurrent.futures.wait([future for _, future in pending])
+
+
+def _sha1_digest(data):
+    """ Return the SHA1 digest of C{data}.
+    """
+    return hashlib.sha1(data).digest()
+
+
+class HashStats(object):
+    """ Timings and counters of creating or checking a metafile.
+
+        Phase timers are in wall-clock seconds; C{read} is the time spent
+        waiting for data (I/O wait), and C{hash} is summed over all hashing
+        threads. C{cpu} is the CPU time the whole process used meanwhile.
+    """
+
+    PHASES = ("walk", "stat", "read", "hash", "encode", "write")
+
+
+    def __init__(self):
+        """ Initialize empty stats.
+        """
+        self.phases = dict.fromkeys(self.PHASES, 0.0)
+        self.files = 0
+        self.reads = 0
+        self.bytes_read = 0
+        self.pieces_hashed = 0
+        self.bytes_hashed = 0
+        self.read_sizes = collections.Counter()
+        self.elapsed = 0.0
+        self.cpu = 0.0
+        self._lock = threading.Lock()
+
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, " ".join(
+            "%s=%.3f" % (phase, self.phases[phase]) for phase in self.PHASES))
+
+
+    @contextmanager
+    def timer(self, phase):
+        """ Add the time spent in a C{with} block to the given phase.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            with self._lock:
+                self.phases[phase] += seconds
+
+
+    @contextmanager
+    def running(self):
+        """ Add the wall-clock and CPU time spent in a C{with} block.
+        """
+        started, cpu_started = time.perf_counter(), time.process_time()
+        try:
+            yield self
+        finally:
+            self.elapsed += time.perf_counter() - started
+            self.cpu += time.process_time() - cpu_started
+
+
+    def add_read(self, size, seconds):
+        """ Count a read of C{size} bytes that took C{seconds}.
+        """
+        self.phases["read"] += seconds
+        self.reads += 1
+        self.bytes_read += size
+        # Histogram of read sizes, by powers of 2
+        self.read_sizes[1 << max(0, size - 1).bit_length()] += 1
+
+
+    def sha1_digest(self, data):
+        """ Return the SHA1 digest of C{data}, counting the time taken.
+        """
+        started = time.perf_counter()
+        digest = hashlib.sha1(data).digest()
+        seconds = time.perf_counter() - started
+        with self._lock:
+            self.phases["hash"] += seconds
+            self.pieces_hashed += 1
+            self.bytes_hashed += len(data)
+        return digest
+
+
+    @property
+    def io_wait(self):
+        """ Seconds spent waiting for the filesystem.
+        """
+        return sum(self.phases[phase] for phase in ("walk", "stat", "read", "write"))
+
+
+    @property
+    def rate(self):
+        """ Hashed bytes per second.
+        """
+        return self.bytes_hashed / self.elapsed if self.elapsed else 0.0
+
+
+    def as_dict(self):
+        """ Return the stats as a dict of plain values.
+        """
+        return {
+            "phases": dict(self.phases),
+            "files": self.files,
+            "reads": self.reads,
+            "bytes_read": self.bytes_read,
+            "read_sizes": dict((str(size), count) for size, count in sorted(self.read_sizes.items())),
+            "pieces_hashed": self.pieces_hashed,
+            "bytes_hashed": self.bytes_hashed,
+            "elapsed": self.elapsed,
+            "cpu": self.cpu,
+            "io_wait": self.io_wait,
+            "rate": self.rate,
+        }
+
+
+    def to_json(self, **kwargs):
+        """ Return the stats as a JSON string; keyword arguments are passed to C{json.dumps}.
+        """
+        return json.dumps(self.as_dict(), sort_keys=True, **kwargs)
+
+
+def is_padding(item):
+    """ Return True if the given file dict of an info dict is a BEP 47 padding file.
+    """
+    attr = item.get("attr")
+    return isinstance(attr, bytes) and b"p" in attr
+
+
+def padding_item(length):
+    """ Return the file dict of a BEP 47 padding file of the given length.
+    """
+    return {"attr": b"p", "length": length, "path": [b".pad", b"%d" % length]}
+
+
+def _as_bytes(text):
+    """ Return a dict key (text if it's valid UTF-8) as bytes.
+    """
+    return text.encode('utf8') if isinstance(text, str) else text
+
+
+def _next_power_of_2(number):
+    """ Return the smallest power of 2 not less than C{number}.
+    """
+    return 1 << max(0, number - 1).bit_length()
+
+
+def _merkle_root(hashes, width, pad):
+    """ Return the root of a SHA-256 merkle tree over C{hashes}, padded
+        to C{width} leaves (a power of 2) with C{pad} hashes.
+    """
+    layer = list(hashes)
+    while width > 1:
+        if len(layer) % 2:
+            layer.append(pad)
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+        pad = hashlib.sha256(pad + pad).digest()
+        width //= 2
+    return layer[0] if layer else pad
+
+
+def v2_piece_root(data, blocks=None):
+    """ Return the BEP 52 merkle root of C{data}, hashed in 16 KiB blocks,
+        with the leaves padded to C{blocks} (default: the next power of 2).
+    """
+    leaves = [hashlib.sha256(data[i:i + V2_BLOCK_SIZE]).digest() for i in range(0, len(data), V2_BLOCK_SIZE)]
+    return _merkle_root(leaves, blocks or _next_power_of_2(len(leaves)), bytes(32))
+
+
+def v2_file_root(piece_hashes, piece_size):
+    """ Return the BEP 52 "pieces root" of a file larger than one piece,
+        from the hashes in its piece layer.
+    """
+    pad = _merkle_root([], piece_size // V2_BLOCK_SIZE, bytes(32))
+    return _merkle_root(piece_hashes, _next_power_of_2(len(piece_hashes)), pad)
+
+
+def file_tree_items(tree, path=()):
+    """ Yield C{(path parts, leaf dict)} for the files of a BEP 52 file tree,
+        in tree order; path parts are text.
+    """
+    for key, node in sorted(tree.items(), key=lambda item: _as_bytes(item[0])):
+        name = key.decode('utf8') if isinstance(key, bytes) else key
+        if "" in node:
+            yield path + (name,), node[""]
+        else:
+            for item in file_tree_items(node, path + (name,)):
+                yield item
+
+
 def check_info(info):
     """ Validate info dict.
 
         Raise ValueError if validation fails.
     """
+    for problem in _info_problems(info):
+        raise ValueError(problem)
+
+    return info
+
+
+def info_violations(info):
+    """ Validate info dict, and return a list of all problems found
+        (empty if the info dict is valid).
+    """
+    return list(_info_problems(info))
+
+
+def _name_problem(name, allowed, message):
+    """ Return a problem description if C{name} is no allowed UTF-8 name, else None.
+    """
+    try:
+        if allowed.match(name.decode('utf8')):
+            return None
+    except UnicodeError:
+        return "bad metainfo - name %r is not UTF-8" % (name,)
+    return message % name
+
+
+def _info_problems(info):
+    """ Generate descriptions of all problems found in an info dict.
+
+        For huge file lists, each distinct path part is only checked
+        once, and duplicates are found by comparing tuples of parts.
+    """
     if not isinstance(info, dict):
-        raise ValueError("bad metainfo - not a dictionary")
+        yield "bad metainfo - not a dictionary"
+        return
 
-    pieces = info.get("pieces")
-    if not isinstance(pieces, bytes) or len(pieces) % 20 != 0:
-        raise ValueError("bad metainfo - bad pieces key")
+    version = info.get("meta version", 1)
+    if version not in (1, 2):
+        yield "bad metainfo - unsupported meta version %r" % (version,)
+        return
+    has_v1 = version == 1 or "pieces" in info
+
+    if has_v1:
+        pieces = info.get("pieces")
+        if not isinstance(pieces, bytes) or len(pieces) % 20 != 0:
+            yield "bad metainfo - bad pieces key"
 
     piece_size = info.get("piece length")
     if not isinstance(piece_size, int) or piece_size <= 0:
-        raise ValueError("bad metainfo - illegal piece length")
+        yield "bad metainfo - illegal piece length"
+    elif version == 2 and (piece_size < V2_BLOCK_SIZE or piece_size & (piece_size - 1)):
+        yield "bad metainfo - v2 piece length must be a power of 2 of at least 16 KiB"
 
     name = info.get("name")
     if not isinstance(name, bytes):
-        raise ValueError("bad metainfo - bad name (type is %r)" % type(name).__name__)
-    if not ALLOWED_ROOT_NAME.match(name.decode('utf8')):
-        raise ValueError("name %s disallowed for security reasons" % name)
-
+        yield "bad metainfo - bad name (type is %r)" % type(name).__name__
+    else:
+        problem = _name_problem(name, ALLOWED_ROOT_NAME, "name %s disallowed for security reasons")
+        if problem:
+            yield problem
+
+    v2_files = None
+    if version == 2:
+        v2_files = []
+        for problem in _file_tree_problems(info.get("file tree"), v2_files):
+            yield problem
+        if not has_v1:
+            return
+
+    v1_files = []
     if ("files" in info) == ("length" in info):
-        raise ValueError("single/multiple file mix")
-
-    if "length" in info:
+        yield "single/multiple file mix"
+        return
+    elif "length" in info:
         length = info.get("length")
         if not isinstance(length, int) or length < 0:
-            raise ValueError("bad metainfo - bad length")
+            yield "bad metainfo - bad length"
+        v1_files.append(((name,), length))
     else:
-        files = info.get("files")
-        if not isinstance(files, (list, tuple)):
-            raise ValueError("bad metainfo - bad file list")
-
-        for item in files:
-            if not isinstance(item, dict):
-                raise ValueError("bad metainfo - bad file value")
-
-            length = item.get("length")
-            if not isinstance(length, int) or length < 0:
-                raise ValueError("bad metainfo - bad length")
-
-            path = item.get("path")
-            if not isinstance(path, (list, tuple)) or not path:
-                raise ValueError("bad metainfo - bad path")
-
-            for part in path:
-                if not isinstance(part, bytes):
-                    raise ValueError("bad metainfo - bad path dir")
-                if part == '..':
-                    raise ValueError("relative path in %s disallowed for security reasons" % '/'.join(path))
-                if part and not ALLOWED_PATH_NAME.match(part.decode('utf8')):
-                    raise ValueError("path %s disallowed for security reasons" % part)
-
-        file_paths = [os.path.join(*[part.decode('utf8') for part in item["path"]]) for item in files]
-        if len(set(file_paths)) != len(file_paths):
-            raise ValueError("bad metainfo - duplicate path")
+        for problem in _file_list_problems(info.get("files"), v1_files):
+            yield problem
 
-    return info
+    # Hybrid metafiles must describe the same files twice
+    if v2_files is not None and v1_files != v2_files:
+        yield "bad metainfo - v1 file list and v2 file tree differ"
+
+
+def _file_list_problems(files, found):
+    """ Generate descriptions of all problems found in a v1 file list,
+        and add C{(path parts, length)} of the valid (non-padding) files to C{found}.
+    """
+    if not isinstance(files, (list, tuple)):
+        yield "bad metainfo - bad file list"
+        return
+
+    part_problems = {b"": None}
+    seen = set()
+    for item in files:
+        if not isinstance(item, dict):
+            yield "bad metainfo - bad file value"
+            continue
+
+        length = item.get("length")
+        if not isinstance(length, int) or length < 0:
+            yield "bad metainfo - bad length"
+
+        if is_padding(item):
+            # Padding files may share names, and are never written to disk
+            continue
+
+        path = item.get("path")
+        if not isinstance(path, (list, tuple)) or not path:
+            yield "bad metainfo - bad path"
+            continue
+
+        valid = True
+        for part in path:
+            if not isinstance(part, bytes):
+                yield "bad metainfo - bad path dir"
+                valid = False
+                continue
+
+            try:
+                problem = part_problems[part]
+            except KeyError:
+                problem = part_problems[part] = _path_part_problem(part)
+            if problem:
+                yield problem
+                valid = False
+
+        if valid:
+            key = tuple(path) if b"" not in path else tuple(part for part in path if part)
+            if key in seen:
+                yield "bad metainfo - duplicate path %s" % b"/".join(key)
+            seen.add(key)
+            found.append((key, length))
+
+
+def _path_part_problem(part):
+    """ Return a problem description if C{part} is not allowed in a path, else None.
+    """
+    if part in (b".", b".."):
+        return "relative path %s disallowed for security reasons" % part
+    return _name_problem(part, ALLOWED_PATH_NAME, "path %s disallowed for security reasons")
+
+
+def _file_tree_problems(tree, found, path=()):
+    """ Generate descriptions of all problems found in a BEP 52 file tree,
+        and add C{(path parts, length)} of its valid files to C{found}.
+    """
+    if not isinstance(tree, dict) or not tree:
+        yield "bad metainfo - bad file tree"
+        return
+
+    for part, node in sorted(((_as_bytes(key), node) for key, node in tree.items()), key=lambda item: item[0]):
+        problem = _path_part_problem(part) if part else "bad metainfo - empty name in file tree"
+        if problem:
+            yield problem
+            continue
+        if not isinstance(node, dict):
+            yield "bad metainfo - bad file tree entry %s" % b"/".join(path + (part,))
+            continue
+
+        leaf = node.get("")
+        if leaf is None:
+            for problem in _file_tree_problems(node, found, path + (part,)):
+                yield problem
+            continue
+
+        length = leaf.get("length") if isinstance(leaf, dict) and len(node) == 1 else None
+        if not isinstance(length, int) or length < 0:
+            yield "bad metainfo - bad file tree entry %s" % b"/".join(path + (part,))
+            continue
+        root = leaf.get("pieces root")
+        if length and (not isinstance(root, bytes) or len(root) != 32):
+            yield "bad metainfo - bad pieces root for %s" % b"/".join(path + (part,))
+            continue
+        found.append((path + (part,), length))
 
 
 def check_meta(meta):
@@ -171,6 +751,8 @@ def check_meta(meta):
         raise ValueError("bad metadata - not a dictionary")
     if not isinstance(meta.get("announce"), bytes):
         raise ValueError("bad announce URL - not a string")
+    if not isinstance(meta.get("piece layers", {}), dict):
+        raise ValueError("bad metadata - bad piece layers")
     check_info(meta.get("info"))
 
     return meta
@@ -280,12 +862,26 @@ def assign_fields(meta, assignments):
 
 def info_hash(metadata):
     """ Return info hash as a string.
+
+        For a C{bencode.BencodeView}, the original bytes of the info dict
+        are hashed directly, without decoding them.
     """
+    if isinstance(metadata, bencode.BencodeView):
+        return hashlib.sha1(metadata.view('info').raw).hexdigest().upper()
     return hashlib.sha1(bencode.bencode(metadata['info'])).hexdigest().upper()
 
 
+def info_hash_v2(metadata):
+    """ Return the SHA-256 info hash of a v2 or hybrid metafile (BEP 52) as a string.
+    """
+    if isinstance(metadata, bencode.BencodeView):
+        return hashlib.sha256(metadata.view('info').raw).hexdigest().upper()
+    return hashlib.sha256(bencode.bencode(metadata['info'])).hexdigest().upper()
+
+
 def data_size(metadata):
-    """ Calculate the size of a torrent based on parsed metadata.
+    """ Calculate the size of a torrent based on parsed metadata
+        (BEP 47 padding files are not counted).
     """
     info = metadata['info']
 
@@ -294,7 +890,7 @@ def data_size(metadata):
         total_size = info['length']
     else:
         # Directory structure
-        total_size = sum([f['length'] for f in info['files']])
+        total_size = sum([f['length'] for f in info['files'] if not is_padding(f)])
 
     return total_size
 
@@ -307,12 +903,20 @@ def checked_open(filename, log=None, quiet=False):
     """
     with closing(open(filename, "rb")) as handle:
         raw_data = handle.read()
-    data = bencode.bdecode(raw_data)
+
+    # Canonical form is checked while decoding, non-canonical data is
+    # only decoded a 2nd time when there's a problem to report
+    noncanonical = None
+    try:
+        data = bencode.bdecode(raw_data, strict=True)
+    except bencode.NonCanonicalError as exc:
+        noncanonical = exc
+        data = bencode.bdecode(raw_data)
 
     try:
         check_meta(data)
-        if raw_data != bencode.bencode(data):
-            raise ValueError("Bad bencoded data - dict keys out of order?")
+        if noncanonical:
+            raise ValueError("Bad bencoded data - %s" % noncanonical)
     except ValueError as exc:
         if log:
             # Warn about it, unless it's a quiet value query
@@ -324,6 +928,42 @@ def checked_open(filename, log=None, quiet=False):
     return data
 
 
+class InventoryEntry(collections.namedtuple("InventoryEntry", "path size dev ino mtime_ns")):
+    """ A data file found when scanning a datapath.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_stat(cls, path, st):
+        """ Create an entry from C{os.stat()} results.
+        """
+        return cls(path, st.st_size, st.st_dev, st.st_ino, st.st_mtime_ns)
+
+    @property
+    def identity(self):
+        """ Identity of the file's content, as used by the piece cache.
+        """
+        return (self.dev, self.ino, self.size, self.mtime_ns)
+
+
+class _TimedWriter(object):
+    """ Pass writes on to a file, adding their time to the "write" phase of a L{HashStats}.
+    """
+
+    def __init__(self, handle, stats):
+        """ Wrap an open file.
+        """
+        self.handle = handle
+        self.stats = stats
+
+
+    def write(self, data):
+        """ Write C{data}, and count the time taken.
+        """
+        with self.stats.timer("write"):
+            return self.handle.write(data)
+
+
 class Metafile(object):
     """ A torrent metafile.
     """
@@ -339,9 +979,13 @@ class Metafile(object):
         """ Initialize metafile.
         """
         self.filename = filename
-        self.progress = None
         self.datapath = datapath
         self.ignore = self.IGNORE_GLOB[:]
+        self.drop_cache = False
+        self.piece_cache = None
+        self.hash_pool = None
+        self.file_digests = None
+        self.piece_layers = None
 
 
     def _get_datapath(self):
@@ -361,13 +1005,34 @@ class Metafile(object):
         else:
             self._datapath = None
             self._fifo = False
+        self._inventory = None
+        self.stats = HashStats()
 
     datapath = property(_get_datapath, _set_datapath)
 
 
-    def walk(self):
-        """ Generate paths in "self.datapath".
+    def _ignore_matcher(self):
+        """ Return a function matching names against all patterns in
+            "self.ignore", compiled into a single regex.
         """
+        patterns = tuple(self.ignore)
+        if getattr(self, "_ignore_cache", (None,))[0] != patterns:
+            regex = re.compile("|".join(fnmatch.translate(i) for i in patterns) or r"(?!)")
+            self._ignore_cache = (patterns, regex.match)
+
+        return self._ignore_cache[1]
+
+
+    def inventory(self):
+        """ Scan "self.datapath" once, and return a list of L{InventoryEntry}
+            tuples for the files in it (sorted by path, except for FIFOs).
+        """
+        if self._inventory is not None:
+            return self._inventory
+
+        entries = []
+        started = time.perf_counter()
+        stat_secs = 0.0
         # FIFO?
         if self._fifo:
             if self._fifo > 1:
@@ -380,121 +1045,314 @@ class Metafile(object):
                     relpath = fifo.readline().rstrip('\n')
                     if not relpath: # EOF?
                         break
-                    yield os.path.join(os.path.dirname(self.datapath), relpath)
-
+                    path = os.path.join(os.path.dirname(self.datapath), relpath)
+                    stat_started = time.perf_counter()
+                    entries.append(InventoryEntry.from_stat(path, os.stat(path)))
+                    stat_secs += time.perf_counter() - stat_started
 
         # Directory?
         elif os.path.isdir(self.datapath):
-            # Walk the directory tree
-            for dirpath, dirnames, filenames in os.walk(self.datapath): #, followlinks=True):
-                # Don't scan blacklisted directories
-                for bad in dirnames[:]:
-                    if any(fnmatch.fnmatch(bad, pattern) for pattern in self.ignore):
-                        dirnames.remove(bad)
-
-                # Yield all filenames that aren't blacklisted
-                for filename in filenames:
-                    if not any(fnmatch.fnmatch(filename, pattern) for pattern in self.ignore):
-                        #yield os.path.join(dirpath[len(self.datapath)+1:], filename)
-                        yield os.path.join(dirpath, filename)
+            # Walk the directory tree, skipping blacklisted names
+            ignored = self._ignore_matcher()
+            pending = [self.datapath]
+            while pending:
+                for entry in os.scandir(pending.pop()):
+                    if ignored(entry.name):
+                        continue
+                    if entry.is_dir():
+                        # Like os.walk(), don't follow symlinked directories
+                        if not entry.is_symlink():
+                            pending.append(entry.path)
+                    else:
+                        stat_started = time.perf_counter()
+                        entries.append(InventoryEntry.from_stat(entry.path, entry.stat()))
+                        stat_secs += time.perf_counter() - stat_started
+            entries.sort()
 
         # Single file
         else:
-            # Yield the filename
-            yield self.datapath
+            stat_started = time.perf_counter()
+            entries.append(InventoryEntry.from_stat(self.datapath, os.stat(self.datapath)))
+            stat_secs += time.perf_counter() - stat_started
+
+        self.stats.phases["walk"] += time.perf_counter() - started - stat_secs
+        self.stats.phases["stat"] += stat_secs
+        self._inventory = entries
+        return entries
+
+
+    def walk(self):
+        """ Generate paths in "self.datapath".
+        """
+        for entry in self.inventory():
+            yield entry.path
 
 
     def _calc_size(self):
         """ Get total size of "self.datapath".
         """
-        return sum(os.path.getsize(filename)
-            for filename in self.walk()
-        )
+        return sum(entry.size for entry in self.inventory())
 
 
-    def _make_info(self, piece_size, progress, walker, piece_callback=None):
-        """ Create info dict.
-        """
-        # These collect the file descriptions and piece hashes
-        file_list = []
-        pieces = []
+    def _read_pieces(self, files, piece_size, progress=None, totalsize=-1, buffers=1, wanted=None):
+        """ Read the given C{(filename, filesize)} pairs as one stream of data,
+            and yield C{((index, filename), data)} for each piece, where
+            C{filename} is the file the piece ends in.
 
-        # Initialize progress state
-        hashing_secs = time.time()
-        totalsize = -1 if self._fifo else self._calc_size()
+            Only pieces whose index is in C{wanted} are read, if given;
+            the data of other pieces is skipped. A filename of None stands
+            for a padding file, which reads as zeros.
+
+            Data is read into a ring of C{buffers} reusable piece buffers,
+            and yielded as a memoryview that is only valid until that buffer
+            comes round again, i.e. until C{buffers} more pieces are read.
+        """
+        ring = [bytearray(piece_size) for _ in range(buffers)]
+        stats = self.stats
+        current = 0
         totalhashed = 0
+        handle, handle_idx, position = None, None, 0
+
+        try:
+            for index, segments in enumerate(piece_segments([size for _, size in files], piece_size)):
+                if wanted is not None and index not in wanted:
+                    totalhashed += sum(length for _, _, length in segments)
+                    if progress:
+                        progress(totalhashed, totalsize)
+                    continue
+
+                view = memoryview(ring[current])
+                done = 0
+                filename = None
+                for file_idx, offset, length in segments:
+                    if files[file_idx][0] is None:
+                        view[done:done + length] = bytes(length)
+                        done += length
+                        totalhashed += length
+                        continue
+
+                    filename = files[file_idx][0]
+                    if file_idx != handle_idx:
+                        if handle:
+                            self._close_handle(handle)
+                        # Unbuffered, so readinto() reads straight into the piece buffer
+                        handle, handle_idx, position = open(filename, "rb", buffering=0), file_idx, 0
+                        self._advise(handle, "SEQUENTIAL", "NOREUSE")
+                        stats.files += 1
+                    if position != offset:
+                        handle.seek(offset)
+
+                    position = offset + length
+                    while length:
+                        read_started = time.perf_counter()
+                        count = handle.readinto(view[done:done + length])
+                        stats.add_read(count or 0, time.perf_counter() - read_started)
+                        if not count:
+                            raise OSError(errno.EIO, "Unexpected end of %r at offset %d" % (
+                                filename, position - length))
+                        done += count
+                        length -= count
+                        totalhashed += count
+
+                        # Report progress
+                        if progress:
+                            progress(totalhashed, totalsize)
+
+                yield (index, filename), view if done == piece_size else view[:done]
+                current = (current + 1) % buffers
+        finally:
+            if handle:
+                self._close_handle(handle)
+
+
+    def _close_handle(self, handle):
+        """ Close a data file after reading it.
+        """
+        try:
+            if self.drop_cache:
+                self._advise(handle, "DONTNEED")
+        finally:
+            handle.close()
+
+
+    @staticmethod
+    def _advise(handle, *advice):
+        """ Give the kernel POSIX_FADV_* hints on how an open file is used,
+            where supported.
+        """
+        if hasattr(os, "posix_fadvise"):
+            for name in advice:
+                try:
+                    os.posix_fadvise(handle.fileno(), 0, 0, getattr(os, "POSIX_FADV_" + name))
+                except (AttributeError, OSError):
+                    pass
+
 
-        # Start a new piece
-        sha1sum = hashlib.sha1()
-        done = 0
+    def _make_info(self, piece_size, progress, entries, workers=1,
+                   file_digests=None, align=None, hybrid=False):
+        """ Create info dict for the given L{InventoryEntry} list.
 
-        # Hash all files
-        for filename in walker:
-            # Assemble file info
-            filesize = os.path.getsize(filename)
-            filepath = filename[len(os.path.dirname(self.datapath) if self._fifo else self.datapath):].lstrip(os.sep)
+            If C{file_digests} names any of L{FILE_DIGESTS}, those are
+            computed for each file in the same pass, and stored in
+            "self.file_digests".
+
+            If C{align} is not None, files of at least that size (and the
+            files following them) start on a piece boundary, using BEP 47
+            padding files.
+
+            With C{hybrid}, a BEP 52 file tree is added (so all files are
+            aligned, and in file tree order), and the piece layers for the
+            top-level "piece layers" key are stored in "self.piece_layers".
+        """
+        # These collect the file descriptions and piece hashes
+        file_list = []
+        files = []
+        relpaths = []
+        identities = []
+        pieces = PieceTable(bytearray())
+        multi_file = self._fifo or os.path.isdir(self.datapath)
+
+        # Assemble file info
+        root = os.path.dirname(self.datapath) if self._fifo else self.datapath
+        if hybrid:
+            entries = sorted(entries, key=lambda entry: [
+                part.encode('utf8') for part in entry.path[len(root):].lstrip(os.sep).split(os.sep)])
+            align = 0
+        offset = 0
+        after_aligned = False
+        for entry in entries:
+            if align is not None and multi_file and entry.size:
+                if offset % piece_size and (after_aligned or entry.size >= align):
+                    padding = piece_size - offset % piece_size
+                    file_list.append(padding_item(padding))
+                    files.append((None, padding))
+                    relpaths.append(None)
+                    identities.append(None)
+                    offset += padding
+                after_aligned = entry.size >= align
+
+            filepath = entry.path[len(root):].lstrip(os.sep)
             file_list.append({
-                "length": filesize,
-                "path": [part.encode('utf8') for part in os.path.split(filepath)],
+                "length": entry.size,
+                "path": [part.encode('utf8') for part in filepath.split(os.sep)],
             })
+            files.append((entry.path, entry.size))
+            relpaths.append(filepath or os.path.basename(entry.path))
+            identities.append(entry.identity)
+            offset += entry.size
 
-            # Open file and hash it
-            fileoffset = 0
-            handle = open(filename, "rb")
-            try:
-                while fileoffset < filesize:
-                    # Read rest of piece or file, whatever is smaller
-                    chunk = handle.read(min(filesize - fileoffset, piece_size - done))
-                    sha1sum.update(chunk) # bogus pylint: disable=E1101
-                    done += len(chunk)
-                    fileoffset += len(chunk)
-                    totalhashed += len(chunk)
-
-                    # Piece is done
-                    if done == piece_size:
-                        pieces.append(sha1sum.digest()) # bogus pylint: disable=E1101
-                        if piece_callback:
-                            piece_callback(filename, pieces[-1])
-
-                        # Start a new piece
-                        sha1sum = hashlib.sha1()
-                        done = 0
-
-                    # Report progress
-                    if progress:
-                        progress(totalhashed, totalsize)
-            finally:
-                handle.close()
-
-        # Add hash of partial last piece
-        if done > 0:
-            pieces.append(sha1sum.digest()) # bogus pylint: disable=E1103
-            if piece_callback:
-                piece_callback(filename, pieces[-1])
+        # Initialize progress state
+        totalsize = offset
+        totalhashed = totalsize
+        layout = list(piece_segments([filesize for _, filesize in files], piece_size))
+        digests = [None] * len(layout)
+
+        # Look up pieces of unchanged data in the cache
+        cache_keys = None
+        if self.piece_cache is not None:
+            cache_keys = [self.piece_cache.key(piece_size, [(identities[file_idx], offset, length)
+                                                            for file_idx, offset, length in segments])
+                          for segments in layout]
+            for index, digest in self.piece_cache.get_many(cache_keys).items():
+                digests[index] = digest
+
+        # Hash all files (only the pieces not found in the cache, unless
+        # per-file digests or v2 hashes are wanted, which need every byte)
+        missing = None if cache_keys is None else [i for i, digest in enumerate(digests) if digest is None]
+        wanted = None if missing is None or file_digests or hybrid else set(missing)
+        reader = self._read_pieces(files, piece_size, progress, totalsize, buffers=2 * workers + 1, wanted=wanted)
+        if hybrid:
+            v2_hashes = [[] for _ in files]
+            reader = self._hash_v2(reader, layout, [size for _, size in files], piece_size, v2_hashes)
+        if file_digests:
+            hashers = [[FILE_DIGESTS[name]() for name in file_digests] if path else [] for path, _ in files]
+            reader = self._digest_files(reader, layout, hashers)
+        for (index, _), digest in hash_pieces(reader, workers, self.hash_pool, self.stats):
+            digests[index] = digest
+        if cache_keys is not None:
+            self.piece_cache.put_many((cache_keys[i], digests[i]) for i in missing)
+
+        if file_digests:
+            self.file_digests = [
+                (relpath, dict((name, hasher.hexdigest()) for name, hasher in zip(file_digests, file_hashers)))
+                for relpath, file_hashers in zip(relpaths, hashers) if relpath is not None
+            ]
+
+        for digest in digests:
+            pieces.append(digest)
 
         # Build the meta dict
         metainfo = {
-            "pieces": b"".join(pieces),
+            "pieces": bytes(pieces),
             "piece length": piece_size,
             "name": os.path.basename(self.datapath).encode('utf8'),
         }
 
         # Handle directory/FIFO vs. single file
-        if self._fifo or os.path.isdir(self.datapath):
+        if multi_file:
             metainfo["files"] = file_list
         else:
             metainfo["length"] = totalhashed
 
-        hashing_secs = time.time() - hashing_secs
+        if hybrid:
+            metainfo["meta version"] = 2
+            metainfo["file tree"] = {}
+            self.piece_layers = {}
+            for (_, size), relpath, hashes in zip(files, relpaths, v2_hashes):
+                if relpath is None:
+                    continue
+                leaf = {"length": size}
+                if size > piece_size:
+                    leaf["pieces root"] = v2_file_root(hashes, piece_size)
+                    self.piece_layers[leaf["pieces root"]] = b"".join(hashes)
+                elif size:
+                    leaf["pieces root"] = hashes[0]
+
+                node = metainfo["file tree"]
+                for part in relpath.split(os.sep):
+                    node = node.setdefault(part, {})
+                node[""] = leaf
 
         # Return validated info dict
         return check_info(metainfo), totalhashed
 
 
-    def _make_meta(self, tracker_url, root_name, private, progress):
-        """ Create torrent dict.
+    def _digest_files(self, reader, layout, hashers):
+        """ Pass pieces through, feeding each file's data to its hashers.
+        """
+        for key, data in reader:
+            with self.stats.timer("hash"):
+                done = 0
+                for file_idx, _, length in layout[key[0]]:
+                    chunk = data[done:done + length]
+                    for hasher in hashers[file_idx]:
+                        hasher.update(chunk)
+                    done += length
+            yield key, data
+
+
+    def _hash_v2(self, reader, layout, sizes, piece_size, v2_hashes=None):
+        """ Calculate the BEP 52 merkle root of each piece of piece-aligned
+            files, and yield C{(key, digest)}; if C{v2_hashes} is given, the
+            digests are added to the list of each file instead, and the
+            pieces are passed through.
+        """
+        blocks = piece_size // V2_BLOCK_SIZE
+        for key, data in reader:
+            with self.stats.timer("hash"):
+                # Aligned pieces start with the data of one file, the rest is padding
+                file_idx, _, length = layout[key[0]][0]
+                digest = v2_piece_root(data[:length], blocks if sizes[file_idx] > piece_size else None)
+            if v2_hashes is None:
+                yield key, digest
+            else:
+                v2_hashes[file_idx].append(digest)
+                yield key, data
+
+
+    def _piece_size(self):
+        """ Calculate piece size for "self.datapath".
         """
-        # Calculate piece size
         if self._fifo:
             # TODO we need to add a (command line) param, probably for total data size
             # for now, always 1MB
@@ -507,10 +1365,13 @@ class Metafile(object):
                 piece_size_exp = 0
 
         piece_size_exp = min(max(15, piece_size_exp), 24)
-        piece_size = 2 ** piece_size_exp
+        return 2 ** piece_size_exp
 
-        # Build info hash
-        info, totalhashed = self._make_info(piece_size, progress, self.walk() if self._fifo else sorted(self.walk()))
+
+    def _make_meta(self, info, tracker_url, root_name, private):
+        """ Create torrent dict for one tracker, from a shared info dict.
+        """
+        info = dict(info)
 
         # Enforce unique hash per tracker
         info["x_cross_seed"] = hashlib.md5(tracker_url.encode('utf8')).hexdigest()
@@ -522,6 +1383,9 @@ class Metafile(object):
         # Freely chosen root name (default is basename of the data path)
         if root_name:
             info["name"] = root_name.encode('utf8')
+            if "length" in info and "file tree" in info:
+                # The file tree of a single file is named after it
+                info["file tree"] = {root_name: list(info["file tree"].values())[0]}
 
         # Torrent metadata
         meta = {
@@ -532,17 +1396,38 @@ class Metafile(object):
         #XXX meta["encoding"] = "UTF-8"
 
         # Return validated meta dict
-        return check_meta(meta), totalhashed
+        return check_meta(meta)
 
 
     def create(self, datapath, tracker_urls, comment=None, root_name=None,
                      created_by=None, private=False, no_date=False, progress=None,
-                     callback=None):
+                     callback=None, workers=1, file_digests=None, manifests=False, align=None,
+                     hybrid=False):
         """ Create a metafile with the path given on object creation.
             Returns the last metafile dict that was written (as an object, not bencoded).
+
+            The data is hashed only once, and one metafile is written per
+            tracker URL. Timings and counters of the call are returned in
+            "self.stats", a new L{HashStats} object for each C{create()} or
+            C{check()}; that attribute is the supported API for them, since
+            the return value is the metafile dict.
+
+            @param workers: Number of threads hashing pieces in parallel.
+            @param file_digests: Names of L{FILE_DIGESTS} to compute for each
+                file while reading it, stored in "self.file_digests" as a list
+                of C{(relative path, {name: hexdigest})} pairs.
+            @param manifests: Also write the per-file digests to manifest files
+                (C{.md5}, C{.sfv}, ...) next to the metafile.
+            @param align: Start files of at least this many bytes (0 for all
+                files) on a piece boundary, by adding BEP 47 padding files.
+            @param hybrid: Create a hybrid v1 + v2 (BEP 52) metafile, hashing
+                the data for both in the same pass.
         """
         if datapath:
             self.datapath = datapath
+        self.stats = HashStats()
+        self.file_digests = None
+        self.piece_layers = None
 
         try:
             tracker_urls = ['' + tracker_urls]
@@ -550,7 +1435,7 @@ class Metafile(object):
             tracker_urls = list(tracker_urls)
         multi_mode = len(tracker_urls) > 1
 
-        # TODO add optimization so the hashing happens only once for multiple URLs!
+        outputs = []
         for tracker_url in tracker_urls:
             # Lookup announce URLs from config file
             try:
@@ -569,40 +1454,330 @@ class Metafile(object):
                 except (IndexError,):
                     continue
                 output_name = ''.join(output_name)
+            outputs.append((tracker_url, output_name))
+
+        with self.stats.running():
+            # Hash the data (once for all trackers)
+            info, totalhashed = self._make_info(self._piece_size(), progress, self.inventory(),
+                                                workers=workers, file_digests=file_digests, align=align,
+                                                hybrid=hybrid)
+
+            for tracker_url, output_name in outputs:
+                meta = self._make_meta(info, tracker_url, root_name, private)
+                if self.piece_layers is not None:
+                    meta["piece layers"] = self.piece_layers
+
+                # Add optional fields
+                if comment:
+                    meta["comment"] = comment.encode('utf8')
+                if created_by:
+                    meta["created by"] = created_by.encode('utf8')
+                if not no_date:
+                    meta["creation date"] = int(time.time())
+                if callback:
+                    callback(meta)
+
+                # Write metafile to disk
+                self._write_meta(output_name, meta)
+
+            if file_digests and manifests:
+                self.write_manifests()
+
+        return meta
+
 
-            # Hash the data
-            meta, totalhashed = self._make_meta(tracker_url, root_name, private, progress)
+    def write_manifests(self, basename=None):
+        """ Write a manifest file for each of the digests in "self.file_digests",
+            named C{basename} (default: the metafile name without extension)
+            plus the digest's extension from L{MANIFEST_EXTENSIONS}.
 
-            # Add optional fields
-            if comment:
-                meta["comment"] = comment.encode('utf8')
-            if created_by:
-                meta["created by"] = created_by.encode('utf8')
-            if not no_date:
-                meta["creation date"] = int(time.time())
-            if callback:
-                callback(meta)
+            @return: List of written filenames.
+        """
+        if not self.file_digests:
+            return []
+        if basename is None:
+            basename = os.path.splitext(self.filename)[0]
+
+        written = []
+        with self.stats.timer("write"):
+            for name in self.file_digests[0][1]:
+                filename = basename + MANIFEST_EXTENSIONS[name]
+                with open(filename, "w", encoding='utf8') as handle:
+                    handle.write(format_manifest(name, self.file_digests))
+                written.append(filename)
+        return written
+
+
+    def retarget(self, metainfo, tracker_url, info_fields=None, datapath=None, sample=3, workers=1):
+        """ Create a metafile for another tracker from an existing one,
+            without hashing the data again; it's written to the filename
+            given on object creation, if there is one.
+
+            The pieces and file list are reused as they are, "x_cross_seed"
+            and the announce URL are set for C{tracker_url}, and the
+            announce list is dropped. Returns the new metafile dict.
+
+            @param info_fields: Dict of other info keys to set (like
+                "source"), or to remove with a value of None.
+            @param datapath: If given, C{sample} random pieces are checked
+                against this data first.
+            @raise ValueError: If the sampled data doesn't match.
+        """
+        if datapath:
+            report = self.check(metainfo, datapath, workers=workers, fail_fast=True, sample=sample)
+            if not report:
+                raise ValueError("data in %r does not match the metafile (%r)" % (datapath, report))
+
+        info = dict(metainfo["info"])
+        for key, value in (info_fields or {}).items():
+            if value is None:
+                info.pop(key, None)
+            else:
+                info[key] = value.encode('utf8') if isinstance(value, str) else value
 
-            # Write metafile to disk
-            bencode.bwrite(output_name, meta)
+        meta = self._make_meta(info, tracker_url, None, info.get("private"))
+        for key, value in metainfo.items():
+            if key not in ("info", "announce", "announce-list"):
+                meta[key] = value
 
+        if self.filename:
+            with self.stats.running():
+                self._write_meta(self.filename, meta)
         return meta
 
 
-    def check(self, metainfo, datapath, progress=None):
+    def _write_meta(self, filename, meta):
+        """ Write a metafile, timing the encoding and writing separately.
+        """
+        stats = self.stats
+        started = time.perf_counter()
+        written = stats.phases["write"]
+        with open(filename, "wb") as handle:
+            bencode.bwrite(_TimedWriter(handle, stats), meta)
+            with stats.timer("write"):
+                handle.flush()
+        stats.phases["encode"] += time.perf_counter() - started - (stats.phases["write"] - written)
+
+
+    def check(self, metainfo, datapath, progress=None, workers=1,
+                    fail_fast=False, sample=None, only_files=None, paths=None, v2=None):
         """ Check piece hashes of a metafile against the given datapath.
+
+            File sizes are checked first; pieces touching missing or
+            truncated files are reported as bad without reading them.
+            Returns a L{CheckReport}, which is true if no problems were found,
+            and has the L{HashStats} of the check in its C{stats} attribute
+            (which is also "self.stats").
+
+            @param workers: Number of threads hashing pieces in parallel.
+            @param fail_fast: Stop at the first problem found.
+            @param sample: Only check this many randomly chosen pieces, or
+                the given piece indices.
+            @param only_files: Only check pieces covering these paths
+                (relative to the datapath, or to the parent of a single file).
+            @param paths: Actual locations of the files, in metainfo order
+                (without BEP 47 padding files), for data that was renamed or moved.
+            @param v2: Check the BEP 52 merkle hashes instead of the v1 piece
+                hashes; by default, only done for v2-only metafiles.
         """
         if datapath:
             self.datapath = datapath
+        self.stats = HashStats()
+        report = CheckReport()
+        report.stats = self.stats
+        started = time.time()
+        with self.stats.running():
+            self._check(report, metainfo, datapath, progress, workers, fail_fast, sample, only_files, paths, v2)
+        report.elapsed = time.time() - started
+        return report
+
+
+    def _check(self, report, metainfo, datapath, progress, workers, fail_fast, sample, only_files, paths, v2):
+        """ Fill in a L{CheckReport}, see L{check}.
+        """
+        info = metainfo["info"]
+        piece_size = int(info["piece length"])
+        if v2 is None:
+            v2 = "pieces" not in info
+        if v2:
+            entries, expected = self._v2_layout(metainfo, datapath)
+        elif "length" in info:
+            expected = PieceTable(info["pieces"])
+            entries = [(os.path.basename(datapath), datapath, info["length"])]
+        else:
+            expected = PieceTable(info["pieces"])
+            entries = [(None, None, item["length"]) if is_padding(item) else
+                       (os.path.join(*[part.decode('utf8') for part in item["path"]]),
+                        os.path.join(datapath, *[part.decode('utf8') for part in item["path"]]),
+                        item["length"]) for item in info["files"]]
+        if paths is not None:
+            data_files = [idx for idx, (relpath, _, _) in enumerate(entries) if relpath is not None]
+            if len(paths) != len(data_files):
+                raise ValueError("got %d paths for %d files" % (len(paths), len(data_files)))
+            for idx, path in zip(data_files, paths):
+                entries[idx] = (entries[idx][0], path, entries[idx][2])
+
+        # Check file sizes (padding files are never on disk)
+        broken = set()
+        for idx, (relpath, path, length) in enumerate(entries):
+            if path is None:
+                continue
+            try:
+                with self.stats.timer("stat"):
+                    size = os.path.getsize(path)
+            except OSError:
+                report.missing_files.append(relpath)
+                broken.add(idx)
+            else:
+                if size < length:
+                    report.truncated_files.append(relpath)
+                    broken.add(idx)
+                elif size > length:
+                    report.oversized_files.append(relpath)
+        if fail_fast and not report:
+            return
+
+        # Select pieces to check
+        layout = list(piece_segments([length for _, _, length in entries], piece_size))
+        if len(layout) != len(expected):
+            raise ValueError("bad metainfo - %d pieces for %d bytes of data" % (
+                len(expected), sum(length for _, _, length in entries)))
+        selected = range(len(layout))
+        if only_files is not None:
+            only_files = set(os.path.normpath(i) for i in only_files)
+            selected = [i for i in selected
+                        if any(entries[file_idx][0] in only_files for file_idx, _, _ in layout[i])]
+        if isinstance(sample, int):
+            if sample < len(selected):
+                selected = sorted(random.sample(list(selected), sample))
+        elif sample is not None:
+            sample = set(sample)
+            selected = [i for i in selected if i in sample]
+
+        wanted = set()
+        for index in selected:
+            if any(file_idx in broken for file_idx, _, _ in layout[index]):
+                report.bad_pieces.append(index)
+            else:
+                wanted.add(index)
+        if fail_fast and report.bad_pieces:
+            wanted.clear()
+
+        # Hash the selected pieces
+        totalsize = sum(sum(length for _, _, length in layout[i]) for i in wanted)
+        reader = self._read_pieces([(path, length) for _, path, length in entries], piece_size,
+                                   None, totalsize, buffers=2 * workers + 1, wanted=wanted)
+        verified = self._verified(reader, report, progress, totalsize)
+        if v2:
+            hashed = self._hash_v2(verified, layout, [length for _, _, length in entries], piece_size)
+        else:
+            hashed = hash_pieces(verified, workers, self.hash_pool, self.stats)
+        try:
+            for (index, _), digest in hashed:
+                report.pieces_checked += 1
+                if digest != expected[index]:
+                    report.bad_pieces.append(index)
+                    if fail_fast:
+                        break
+        finally:
+            hashed.close()
+
+        report.bad_pieces.sort()
+        bad_files = set(file_idx for index in report.bad_pieces for file_idx, _, _ in layout[index])
+        report.damaged_files = [entries[i][0] for i in sorted(bad_files) if entries[i][0] is not None]
+
+
+    @staticmethod
+    def _v2_layout(metainfo, datapath):
+        """ Return the C{(relative path, path, length)} entries of a v2
+            metafile's files, in piece-aligned layout with padding entries,
+            and the expected merkle hash of each piece.
+        """
+        info = metainfo["info"]
+        piece_size = int(info["piece length"])
+        if "file tree" not in info:
+            raise ValueError("bad metainfo - no v2 file tree")
+        items = list(file_tree_items(info["file tree"]))
+        single = "length" in info or (len(items) == 1 and len(items[0][0]) == 1 and "files" not in info
+                                      and _as_bytes(items[0][0][0]) == info.get("name"))
+        layers = metainfo.get("piece layers", {})
+
+        entries, expected = [], []
+        offset = 0
+        for parts, leaf in items:
+            length = leaf["length"]
+            if length and offset % piece_size:
+                entries.append((None, None, piece_size - offset % piece_size))
+                offset += entries[-1][2]
+
+            relpath = os.path.join(*parts)
+            if single:
+                entries.append((os.path.basename(datapath), datapath, length))
+            else:
+                entries.append((relpath, os.path.join(datapath, relpath), length))
+            offset += length
+
+            root = leaf.get("pieces root")
+            if length > piece_size:
+                layer = layers.get(root)
+                if layer is None:
+                    try:
+                        layer = layers.get(root.decode('utf8'))
+                    except UnicodeError:
+                        pass
+                hashes = [layer[i:i + 32] for i in range(0, len(layer or b""), 32)]
+                if len(hashes) != (length + piece_size - 1) // piece_size or v2_file_root(hashes, piece_size) != root:
+                    raise ValueError("bad metainfo - bad piece layer for %s" % relpath)
+                expected.extend(hashes)
+            elif length:
+                expected.append(root)
+
+        return entries, expected
+
+
+    @staticmethod
+    def _verified(reader, report, progress, totalsize):
+        """ Pass pieces through, counting the verified bytes.
+        """
+        for key, data in reader:
+            report.bytes_verified += len(data)
+            if progress:
+                progress(report.bytes_verified, totalsize)
+            yield key, data
 
-        def check_piece(filename, piece):
-            "Callback for new piece"
-            check_piece.piece_index += 20
-        check_piece.piece_index = 0
 
-        datameta, totalhashed = self._make_info(int(metainfo["info"]["piece length"]), progress,
-            [datapath] if "length" in metainfo["info"] else
-            (os.path.join(*([datapath] + i["path"])) for i in metainfo["info"]["files"]),
-            piece_callback=check_piece
+class CheckReport(object):
+    """ Result of checking data against a metafile; true if no problems were found.
+    """
+
+    def __init__(self):
+        """ Initialize empty report.
+        """
+        self.bad_pieces = []
+        self.damaged_files = []
+        self.missing_files = []
+        self.truncated_files = []
+        self.oversized_files = []
+        self.pieces_checked = 0
+        self.bytes_verified = 0
+        self.elapsed = 0.0
+        self.stats = None
+
+
+    def __bool__(self):
+        return not (self.bad_pieces or self.missing_files or self.truncated_files or self.oversized_files)
+
+
+    def __repr__(self):
+        return "<%s %s bad_pieces=%d missing=%d truncated=%d oversized=%d checked=%d>" % (
+            self.__class__.__name__, "OK" if self else "FAILED", len(self.bad_pieces),
+            len(self.missing_files), len(self.truncated_files), len(self.oversized_files),
+            self.pieces_checked,
         )
-        return datameta["pieces"] == metainfo["info"]["pieces"]
+
+
+    @property
+    def rate(self):
+        """ Verified bytes per second.
+        """
+        return self.bytes_verified / self.elapsed if self.elapsed else 0.0
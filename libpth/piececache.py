@@ -0,0 +1,138 @@
+""" Persistent cache of piece hashes.
+
+    Pieces are keyed by the identity of the data they cover (device,
+    inode, size and mtime of each file, plus piece length and offsets),
+    so unchanged data is never hashed twice when metafiles are rebuilt.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class PieceCache(object):
+    """ A piece hash cache stored in an SQLite database, with LRU eviction.
+
+        Assign an instance to C{Metafile.piece_cache} to use it.
+    """
+
+    # Approximate size of one entry on disk (key, digest, timestamp and b-tree overhead)
+    ENTRY_SIZE = 64
+
+
+    def __init__(self, filename, max_size=64 * 2**20):
+        """ Open or create the cache database.
+
+            @param max_size: Approximate size limit in bytes; the least
+                recently used entries are evicted beyond it.
+        """
+        self.filename = filename
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS pieces ("
+                         " key BLOB PRIMARY KEY, digest BLOB NOT NULL, used REAL NOT NULL"
+                         ") WITHOUT ROWID")
+        self._db.execute("CREATE INDEX IF NOT EXISTS pieces_used ON pieces (used)")
+        self._db.commit()
+
+
+    def __repr__(self):
+        return "<%s %r entries=%d hits=%d misses=%d>" % (
+            self.__class__.__name__, self.filename, len(self), self.hits, self.misses,
+        )
+
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM pieces").fetchone()[0]
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *_):
+        self.close()
+
+
+    @staticmethod
+    def identity(filename):
+        """ Return the identity of a file's current content.
+        """
+        stat = os.stat(filename)
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+    @staticmethod
+    def key(piece_size, segments):
+        """ Return the cache key of a piece made of C{(identity, offset, length)} segments.
+        """
+        return hashlib.sha1(repr((piece_size, segments)).encode('ascii')).digest()
+
+
+    def get_many(self, keys, batch=500):
+        """ Look up a list of keys, and return a dict mapping the list
+            index of each key found to its digest.
+        """
+        found = {}
+        positions = {}
+        for idx, key in enumerate(keys):
+            positions.setdefault(key, []).append(idx)
+
+        unique = list(positions)
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(unique), batch):
+                chunk = unique[start:start + batch]
+                rows = self._db.execute("SELECT key, digest FROM pieces WHERE key IN (%s)"
+                                        % ",".join("?" * len(chunk)), chunk).fetchall()
+                for key, digest in rows:
+                    for idx in positions[key]:
+                        found[idx] = bytes(digest)
+                self._db.executemany("UPDATE pieces SET used = ? WHERE key = ?",
+                                     [(now, key) for key, _ in rows])
+            self._db.commit()
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+
+    def put_many(self, items):
+        """ Store C{(key, digest)} pairs, and evict old entries if the cache is full.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO pieces (key, digest, used) VALUES (?, ?, ?)",
+                                 ((key, digest, now) for key, digest in items))
+            self._evict()
+            self._db.commit()
+
+
+    def _evict(self):
+        """ Remove least recently used entries beyond the size limit.
+        """
+        excess = self._db.execute("SELECT COUNT(*) FROM pieces").fetchone()[0] \
+            - self.max_size // self.ENTRY_SIZE
+        if excess > 0:
+            self._db.execute("DELETE FROM pieces WHERE key IN"
+                             " (SELECT key FROM pieces ORDER BY used LIMIT ?)", (excess,))
+
+
+    def clear(self):
+        """ Remove all entries, and reset the counters.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM pieces")
+            self._db.commit()
+        self.hits = self.misses = 0
+
+
+    def close(self):
+        """ Close the database.
+        """
+        self._db.close()
@@ -1,13 +1,19 @@
 import os
 import re
 import sys
+import json
 import errno
 import pipes
 import shlex
 import shutil
 import signal
+import hashlib
+import tempfile
 import subprocess
+import contextlib
+import collections
 import multiprocessing
+import concurrent.futures
 import mutagen.flac
 from .utils import locate, ext_matcher
 
@@ -17,6 +23,12 @@ ENCODERS = {
     'FLAC': {'enc': 'flac', 'ext': '.flac', 'opts': '--best'},
 }
 
+# Infix of transcodes which are still being written
+PARTIAL_SUFFIX = '.part'
+
+# Name of the manifest in a transcode directory
+MANIFEST_NAME = '.transcode.json'
+
 
 class TranscodeException(Exception):
     pass
@@ -71,20 +83,145 @@ def run_pipeline(cmds):
     return results
 
 
+FlacStream = collections.namedtuple('FlacStream', 'sample_rate bits_per_sample channels length size')
+
+
+def probe_flac(flac_file):
+    '''
+    Returns the FlacStream info (sample rate, bit depth, channels,
+    duration in seconds and file size) of a FLAC file.
+    '''
+    info = mutagen.flac.FLAC(flac_file).info
+    return FlacStream(info.sample_rate, info.bits_per_sample, info.channels, info.length,
+                      os.path.getsize(flac_file))
+
+
+def target_sample_rate(original_rate):
+    '''
+    Returns the rate to which audio of the given sample rate should be
+    resampled, or None if it isn't a multiple of 44.1 or 48kHz.
+    '''
+    if original_rate % 44100 == 0:
+        return 44100
+    elif original_rate % 48000 == 0:
+        return 48000
+    else:
+        return None
+
+
+def needs_resample(stream):
+    '''
+    Returns True if a FLAC with the given FlacStream info needs
+    resampling when transcoded.
+    '''
+    return stream.sample_rate > 48000 or stream.bits_per_sample > 16
+
+
+class ReleaseProbe(object):
+    '''
+    The FlacStream info of every FLAC in a release, read in one parallel
+    pass, and the release-level transcode decisions based on it.
+
+    - `flac_dir`: The release directory.
+    - `max_threads`: Number of threads reading FLAC headers.
+    '''
+    def __init__(self, flac_dir, max_threads=None):
+        self.flac_dir = os.path.abspath(flac_dir)
+        flac_files = list(locate(self.flac_dir, ext_matcher('.flac')))
+        # same default as the transcoding pool
+        with concurrent.futures.ThreadPoolExecutor(max_threads or multiprocessing.cpu_count()) as pool:
+            self.streams = collections.OrderedDict(zip(flac_files, pool.map(probe_flac, flac_files)))
+
+        # The resample rate of a file is decided by the highest rate in
+        # its directory and all subdirectories, like resample_rate()
+        max_rates = {}
+        for flac_file, stream in self.streams.items():
+            directory = os.path.dirname(flac_file)
+            while True:
+                max_rates[directory] = max(max_rates.get(directory, 0), stream.sample_rate)
+                parent = os.path.dirname(directory)
+                if directory == self.flac_dir or parent == directory:
+                    break
+                directory = parent
+        self.resample_rates = dict((directory, target_sample_rate(rate)) for directory, rate in max_rates.items())
+
+    @property
+    def is_24bit(self):
+        '''
+        True if any FLAC in the release is 24 bit.
+        '''
+        return any(stream.bits_per_sample > 16 for stream in self.streams.values())
+
+    @property
+    def is_multichannel(self):
+        '''
+        True if any FLAC in the release is multichannel.
+        '''
+        return any(stream.channels > 2 for stream in self.streams.values())
+
+    @property
+    def needs_resampling(self):
+        '''
+        True if any FLAC in the release needs resampling when transcoded.
+        '''
+        return self.is_24bit
+
+    @property
+    def length(self):
+        '''
+        Total duration of the release, in seconds.
+        '''
+        return sum(stream.length for stream in self.streams.values())
+
+    @property
+    def size(self):
+        '''
+        Total size of the release's FLAC files, in bytes.
+        '''
+        return sum(stream.size for stream in self.streams.values())
+
+    def resample_rate(self, flac_file):
+        '''
+        Returns the rate to which the given file should be resampled.
+        '''
+        return self.resample_rates[os.path.dirname(flac_file)]
+
+    def check(self):
+        '''
+        Raises the exception a transcode of any file in the release would
+        fail with, before anything is transcoded.
+        '''
+        for flac_file, stream in self.streams.items():
+            check_stream(flac_file, stream, self.resample_rate(flac_file))
+
+
+def check_stream(flac_file, stream, needed_sample_rate):
+    '''
+    Raises an exception if a FLAC with the given FlacStream info can't be
+    transcoded.
+    '''
+    if needs_resample(stream) and needed_sample_rate is None:
+        raise UnknownSampleRateException(
+            'FLAC file "{0}" has a sample rate {1}, which is not 88.2, '
+            '176.4, or 96kHz, but needs resampling. This is unsupported.'.format(flac_file, stream.sample_rate)
+        )
+
+    if stream.channels > 2:
+        raise TranscodeDownmixException('FLAC file "%s" has more than 2 channels, unsupported' % flac_file)
+
+
 def is_24bit(flac_dir):
     '''
     Returns True if any FLAC within flac_dir is 24 bit.
     '''
-    flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-    return any(flac.info.bits_per_sample > 16 for flac in flacs)
+    return ReleaseProbe(flac_dir).is_24bit
 
 
 def is_multichannel(flac_dir):
     '''
     Returns True if any FLAC within flac_dir is multichannel.
     '''
-    flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-    return any(flac.info.channels > 2 for flac in flacs)
+    return ReleaseProbe(flac_dir).is_multichannel
 
 
 def needs_resampling(flac_dir):
@@ -92,21 +229,15 @@ def needs_resampling(flac_dir):
     Returns True if any FLAC within flac_dir needs resampling when
     transcoded.
     '''
-    return is_24bit(flac_dir)
+    return ReleaseProbe(flac_dir).needs_resampling
 
 
 def resample_rate(flac_dir):
     '''
     Returns the rate to which the release should be resampled.
     '''
-    flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-    original_rate = max(flac.info.sample_rate for flac in flacs)
-    if original_rate % 44100 == 0:
-        return 44100
-    elif original_rate % 48000 == 0:
-        return 48000
-    else:
-        return None
+    flac_files = locate(flac_dir, ext_matcher('.flac'))
+    return target_sample_rate(max(probe_flac(flac_file).sample_rate for flac_file in flac_files))
 
 
 def transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file):
@@ -141,37 +272,182 @@ def transcode_commands(output_format, resample, needed_sample_rate, flac_file, t
     if output_format == 'FLAC' and resample:
         commands = ['sox %(FLAC)s -G -b 16 %(FILE)s rate -v -L %(SAMPLERATE)s dither' % transcode_args]
     else:
-        commands = map(lambda cmd: cmd % transcode_args, transcoding_steps)
+        commands = [cmd % transcode_args for cmd in transcoding_steps]
     return commands
 
 
-# Pool.map() can't pickle lambdas, so we need a helper function.
-def pool_transcode(args):
-    return transcode(*args)
+def tee_commands(output_formats, resample, needed_sample_rate, flac_file, transcode_files):
+    '''
+    Return the decoder command for flac_file (resampling it, if needed),
+    and one encoder command per output format, reading the decoded WAV
+    stream from stdin and writing the matching transcode_file.
+    '''
+    if resample:
+        flac_decoder = 'sox %(FLAC)s -G -b 16 -t wav - rate -v -L %(SAMPLERATE)s dither'
+    else:
+        flac_decoder = 'flac -dcs -- %(FLAC)s'
+
+    # sox can't know the WAV chunk sizes when writing to a pipe
+    lame_encoder = 'lame -S %(OPTS)s - %(FILE)s'
+    flac_encoder = 'flac -s --ignore-chunk-sizes %(OPTS)s -o %(FILE)s -'
+
+    decoder = flac_decoder % {
+        'FLAC': pipes.quote(flac_file),
+        'SAMPLERATE': needed_sample_rate,
+    }
+    encoders = []
+    for output_format, transcode_file in zip(output_formats, transcode_files):
+        encoder = lame_encoder if ENCODERS[output_format]['enc'] == 'lame' else flac_encoder
+        encoders.append(encoder % {
+            'FILE': pipes.quote(transcode_file),
+            'OPTS': ENCODERS[output_format]['opts'],
+        })
+    return decoder, encoders
 
 
-def transcode(flac_file, output_dir, output_format):
+def run_tee(decoder, encoders, chunk_size=2**16):
+    '''
+    Like run_pipeline(), but the output of the decoder command is fed to
+    all encoder commands at the same time. Returns a (code, stderr) pair
+    per process, the decoder's first.
+    '''
+    # stderr goes to temporary files, so no process can block on a full pipe
+    stderr_files = [tempfile.TemporaryFile() for _ in range(len(encoders) + 1)]
+    sigpipe_handler = signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    procs = []
+    try:
+        procs.append(subprocess.Popen(shlex.split(decoder), stdout=subprocess.PIPE, stderr=stderr_files[0]))
+        for cmd, stderr_file in zip(encoders, stderr_files[1:]):
+            procs.append(subprocess.Popen(shlex.split(cmd), stdin=subprocess.PIPE,
+                                          stdout=subprocess.DEVNULL, stderr=stderr_file))
+    except:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        raise
+    finally:
+        signal.signal(signal.SIGPIPE, sigpipe_handler)
+
+    # Copy the decoded stream to every encoder that is still running
+    sinks = [proc.stdin for proc in procs[1:]]
+    while sinks:
+        chunk = procs[0].stdout.read(chunk_size)
+        if not chunk:
+            break
+        for sink in list(sinks):
+            try:
+                sink.write(chunk)
+            except BrokenPipeError:
+                sinks.remove(sink)
+                _close_quietly(sink)
+
+    # Ensure the decoder receives SIGPIPE if all encoders exited first
+    procs[0].stdout.close()
+    for sink in sinks:
+        _close_quietly(sink)
+
+    results = []
+    for proc, stderr_file in zip(procs, stderr_files):
+        proc.wait()
+        stderr_file.seek(0)
+        results.append((proc.returncode, stderr_file.read()))
+        stderr_file.close()
+    return results
+
+
+def _close_quietly(stream):
+    try:
+        stream.close()
+    except BrokenPipeError:
+        pass
+
+
+# Pool.imap_unordered() can't pickle lambdas, so we need a helper function.
+def pool_transcode_targets(args):
+    '''
+    Transcodes a FLAC file into all formats of `output_dirs`, and
+    returns it with the stat and SHA1 of the content that was
+    transcoded, and a dict of transcoded files by format.
+
+    The source is hashed right before it's transcoded, unless
+    `known_sha1` is given and its size and mtime are still those of
+    `source_stat`. If it changes while being transcoded, None is
+    returned instead of its SHA1, so it's not recorded as done.
+    '''
+    flac_file, output_dirs, stream, needed_sample_rate, source_stat, known_sha1 = args
+    stat = os.stat(flac_file)
+    if known_sha1 is not None and same_stat(stat, source_stat):
+        sha1 = known_sha1
+    else:
+        sha1 = file_sha1(flac_file)
+
+    if len(output_dirs) == 1:
+        [(output_format, output_dir)] = output_dirs.items()
+        transcode_files = {output_format: transcode(flac_file, output_dir, output_format, stream, needed_sample_rate)}
+    else:
+        transcode_files = transcode_multi(flac_file, output_dirs, stream, needed_sample_rate)
+
+    if not same_stat(os.stat(flac_file), stat):
+        sha1 = None
+    return flac_file, stat, sha1, transcode_files
+
+
+def transcode(flac_file, output_dir, output_format, stream=None, needed_sample_rate=None):
     '''
     Transcodes a FLAC file into another format.
+
+    `stream` and `needed_sample_rate` are the file's FlacStream info and
+    the release's resample rate from a ReleaseProbe; if not given, they
+    are read from the file and its directory.
     '''
     # gather metadata from the flac file
-    flac_info = mutagen.flac.FLAC(flac_file)
-    sample_rate = flac_info.info.sample_rate
-    bits_per_sample = flac_info.info.bits_per_sample
-    resample = sample_rate > 48000 or bits_per_sample > 16
+    if stream is None:
+        stream = probe_flac(flac_file)
+        needed_sample_rate = resample_rate(os.path.dirname(flac_file))
+    resample = needs_resample(stream)
 
     # if resampling isn't needed then needed_sample_rate will not be used.
-    needed_sample_rate = resample_rate(os.path.dirname(flac_file))
+    check_stream(flac_file, stream, needed_sample_rate)
 
-    if resample and needed_sample_rate is None:
-        raise UnknownSampleRateException(
-            'FLAC file "{0}" has a sample rate {1}, which is not 88.2,',
-            '176.4, or 96kHz, but needs resampling. This is unsupported.'.format(flac_file, sample_rate)
-        )
+    transcode_file = make_transcode_file(flac_file, output_dir, output_format)
+    with partial_files([transcode_file]) as (partial_file,):
+        commands = transcode_commands(output_format, resample, needed_sample_rate, flac_file, partial_file)
+        results = run_pipeline(commands)
+        check_results(flac_file, commands, results)
+
+    return transcode_file
 
-    if flac_info.info.channels > 2:
-        raise TranscodeDownmixException('FLAC file "%s" has more than 2 channels, unsupported' % flac_file)
 
+def transcode_multi(flac_file, output_dirs, stream=None, needed_sample_rate=None):
+    '''
+    Transcodes a FLAC file into several formats at once, decoding (and
+    resampling) it only once. Returns a dict of transcoded files by
+    format.
+
+    - `output_dirs`: A dict of output directories by format.
+    '''
+    if stream is None:
+        stream = probe_flac(flac_file)
+        needed_sample_rate = resample_rate(os.path.dirname(flac_file))
+    resample = needs_resample(stream)
+    check_stream(flac_file, stream, needed_sample_rate)
+
+    transcode_files = dict((output_format, make_transcode_file(flac_file, output_dir, output_format))
+                           for output_format, output_dir in output_dirs.items())
+    formats = sorted(transcode_files)
+    with partial_files([transcode_files[output_format] for output_format in formats]) as partials:
+        decoder, encoders = tee_commands(formats, resample, needed_sample_rate, flac_file, partials)
+        results = run_tee(decoder, encoders)
+        check_results(flac_file, [decoder] + encoders, results)
+
+    return transcode_files
+
+
+def make_transcode_file(flac_file, output_dir, output_format):
+    '''
+    Returns the name of the transcode of flac_file in output_dir, and
+    creates output_dir if needed.
+    '''
     # determine the new filename
     transcode_basename = os.path.splitext(os.path.basename(flac_file))[0]
     transcode_basename = re.sub(r'[\?<>\\*\|"]', '_', transcode_basename)
@@ -189,9 +465,43 @@ def transcode(flac_file, output_dir, output_format):
             else:
                 raise e
 
-    commands = transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file)
-    results = run_pipeline(commands)
+    return transcode_file
+
+
+def partial_name(transcode_file):
+    '''
+    Returns the name a transcode is written to until it is complete.
+    It's a dotfile, so locate() and torrent creation skip it, and it
+    keeps the extension, since sox picks its output format by it.
+    '''
+    dirname, basename = os.path.split(transcode_file)
+    base, ext = os.path.splitext(basename)
+    return os.path.join(dirname, '.' + base + PARTIAL_SUFFIX + ext)
+
+
+@contextlib.contextmanager
+def partial_files(transcode_files):
+    '''
+    Yields the partial names of transcode_files, and renames them to
+    their final names if the block succeeds, so a transcode file never
+    exists half-written. Partial files are removed on failure.
+    '''
+    partials = [partial_name(transcode_file) for transcode_file in transcode_files]
+    try:
+        yield partials
+        for partial, transcode_file in zip(partials, transcode_files):
+            os.replace(partial, transcode_file)
+    except:
+        for partial in partials:
+            if os.path.exists(partial):
+                os.remove(partial)
+        raise
+
 
+def check_results(flac_file, commands, results):
+    '''
+    Raises a TranscodeException if any process of a transcode failed.
+    '''
     # Check for problems. Because it's a pipeline, the earliest one is
     # usually the source. The exception is -SIGPIPE, which is caused
     # by "backpressure" due to a later command failing: ignore those
@@ -207,7 +517,126 @@ def transcode(flac_file, output_dir, output_format):
         # XXX: this should probably never happen....
         raise TranscodeException('Transcode of file "%s" failed: SIGPIPE' % flac_file)
 
-    return transcode_file
+
+def same_stat(stat, other):
+    '''
+    True if two stat results have the same size and mtime.
+    '''
+    return (stat.st_size, stat.st_mtime) == (other.st_size, other.st_mtime)
+
+
+def file_sha1(filename, chunk_size=2**20):
+    '''
+    Returns the SHA1 hex digest of a file's content.
+    '''
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class TranscodeManifest(object):
+    '''
+    Records which source file (by size, mtime and SHA1) each file in a
+    transcode directory was made from, so an interrupted or outdated
+    transcode can be completed by redoing only missing or stale files.
+
+    The manifest is kept in the transcode directory as MANIFEST_NAME;
+    being a dotfile, it's not copied or added to torrents. Sources are
+    keyed by their path relative to the release, outputs are relative
+    to the transcode directory.
+    '''
+    def __init__(self, transcode_dir, output_format):
+        self.transcode_dir = transcode_dir
+        self.filename = os.path.join(transcode_dir, MANIFEST_NAME)
+        self.output_format = output_format
+        self.files = {}
+        self.load()
+
+    def load(self):
+        '''
+        Reads the manifest, if any. Entries made with other encoder
+        settings are dropped, so those files are transcoded again.
+        '''
+        try:
+            with open(self.filename) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            # a damaged manifest only means everything is redone
+            return
+        if manifest.get('format') == self.output_format and manifest.get('opts') == ENCODERS[self.output_format]['opts']:
+            self.files = manifest.get('files', {})
+
+    def save(self):
+        '''
+        Writes the manifest atomically.
+        '''
+        manifest = {
+            'format': self.output_format,
+            'opts': ENCODERS[self.output_format]['opts'],
+            'files': self.files,
+        }
+        fd, tmp_name = tempfile.mkstemp(prefix=MANIFEST_NAME + '.', dir=self.transcode_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp_name, self.filename)
+        except:
+            os.remove(tmp_name)
+            raise
+
+    def is_current(self, source, source_stat, needed_sample_rate, sha1):
+        '''
+        Returns True if the transcode of `source` exists and was made
+        from its current content with the same sample rate. `sha1` is
+        called to hash the source only if just its mtime has changed.
+        '''
+        entry = self.files.get(source)
+        if entry is None or entry['sample_rate'] != needed_sample_rate or entry['size'] != source_stat.st_size:
+            return False
+        if not os.path.exists(os.path.join(self.transcode_dir, entry['output'])):
+            return False
+        if entry['mtime'] != source_stat.st_mtime:
+            # touched, but possibly not changed
+            if entry['sha1'] != sha1():
+                return False
+            entry['mtime'] = source_stat.st_mtime
+        return True
+
+    def known_sha1(self, source, source_stat):
+        '''
+        Returns the recorded SHA1 of `source`, if its size and mtime
+        haven't changed since.
+        '''
+        entry = self.files.get(source)
+        if entry is not None and (entry['size'], entry['mtime']) == (source_stat.st_size, source_stat.st_mtime):
+            return entry['sha1']
+        return None
+
+    def add(self, source, source_stat, needed_sample_rate, sha1, transcode_file):
+        self.files[source] = {
+            'size': source_stat.st_size,
+            'mtime': source_stat.st_mtime,
+            'sha1': sha1,
+            'sample_rate': needed_sample_rate,
+            'output': os.path.relpath(transcode_file, self.transcode_dir),
+        }
+
+    def prune(self, sources):
+        '''
+        Removes the entries and transcodes of files not in `sources`
+        any more, along with partial files left by an interrupted run.
+        '''
+        for source in set(self.files) - set(sources):
+            transcode_file = os.path.join(self.transcode_dir, self.files.pop(source)['output'])
+            if os.path.exists(transcode_file):
+                os.remove(transcode_file)
+        partial = re.compile(r'^\..*' + re.escape(PARTIAL_SUFFIX) + r'\.[^.]+$')
+        for filename in locate(self.transcode_dir, partial.match, ignore_dotfiles=False):
+            os.remove(filename)
 
 
 def get_transcode_dir(flac_dir, output_dir, output_format, resample):
@@ -231,36 +660,45 @@ def get_transcode_dir(flac_dir, output_dir, output_format, resample):
     return os.path.join(output_dir, transcode_dir)
 
 
-def transcode_release(flac_dir, output_dir, output_format, max_threads=None):
+def transcode_release(flac_dir, output_dir, output_format, max_threads=None, resume=False):
     '''
-    Transcode a FLAC release into another format.
+    Transcode a FLAC release into another format, or into several
+    formats at once.
+
+    If `output_format` is a list of formats, each FLAC file is decoded
+    only once and fed to all encoders, and a dict of transcode
+    directories by format is returned.
+
+    With `resume`, existing transcode directories are completed rather
+    than refused: only files which are missing, or whose source has
+    changed since, are transcoded, and transcodes of removed source
+    files are deleted. This also tops up a transcode with files added
+    to the release later. Completed files are kept if a transcode fails.
     '''
     flac_dir = os.path.abspath(flac_dir)
     output_dir = os.path.abspath(output_dir)
-    flac_files = locate(flac_dir, ext_matcher('.flac'))
+    multi = not isinstance(output_format, str)
+    output_formats = list(output_format) if multi else [output_format]
 
-    # check if we need to resample
-    resample = needs_resampling(flac_dir)
+    # read all FLAC headers once, and check if we need to resample
+    probe = ReleaseProbe(flac_dir, max_threads)
+    flac_files = list(probe.streams)
+    resample = probe.needs_resampling
 
     # check if we need to encode
-    if output_format == 'FLAC' and not resample:
+    transcode_dirs = collections.OrderedDict()
+    if 'FLAC' in output_formats and not resample:
         # XXX: if output_dir is not the same as flac_dir, this may not
         # do what the user expects.
         if output_dir != os.path.dirname(flac_dir):
             print("Warning: no encode necessary, so files won't be placed in", output_dir)
-        return flac_dir
-
-    # make a new directory for the transcoded files
-    #
-    # NB: The cleanup code that follows this block assumes that
-    # transcode_dir is a new directory created exclusively for this
-    # transcode. Do not change this assumption without considering the
-    # consequences!
-    transcode_dir = get_transcode_dir(flac_dir, output_dir, output_format, resample)
-    if not os.path.exists(transcode_dir):
-        os.makedirs(transcode_dir)
-    else:
-        raise TranscodeException('transcode output directory "%s" already exists' % transcode_dir)
+        transcode_dirs['FLAC'] = flac_dir
+        output_formats.remove('FLAC')
+    if not output_formats:
+        return transcode_dirs if multi else flac_dir
+
+    # refuse releases that can't be transcoded before doing any work
+    probe.check()
 
     # To ensure that a terminated pool subprocess terminates its
     # children, we make each pool subprocess a process group leader,
@@ -280,45 +718,105 @@ def transcode_release(flac_dir, output_dir, output_format, max_threads=None):
 
         signal.signal(signal.SIGTERM, sigterm_handler)
 
+    # refuse to overwrite existing transcodes, unless resuming
+    for fmt in output_formats:
+        transcode_dir = get_transcode_dir(flac_dir, output_dir, fmt, resample)
+        if os.path.exists(transcode_dir) and not resume:
+            raise TranscodeException('transcode output directory "%s" already exists' % transcode_dir)
+    created_dirs = []
     try:
+        # make new directories for the transcoded files
+        #
+        # NB: Unless resuming, the cleanup code below assumes that every
+        # directory in created_dirs is a new directory created exclusively
+        # for this transcode. Do not change this assumption without
+        # considering the consequences!
+        manifests = {}
+        for fmt in output_formats:
+            transcode_dirs[fmt] = get_transcode_dir(flac_dir, output_dir, fmt, resample)
+            if not os.path.exists(transcode_dirs[fmt]):
+                os.makedirs(transcode_dirs[fmt])
+                created_dirs.append(transcode_dirs[fmt])
+            manifests[fmt] = TranscodeManifest(transcode_dirs[fmt], fmt)
+
+        # find the transcodes to do, hashing sources only if they were touched
+        sources = dict((filename, os.path.relpath(filename, flac_dir)) for filename in flac_files)
+        sample_rates = {}
+        hashes = {}
+        jobs = []
+        for filename in flac_files:
+            source_stat = os.stat(filename)
+            needed_sample_rate = probe.resample_rate(filename) if needs_resample(probe.streams[filename]) else None
+            sample_rates[filename] = needed_sample_rate
+
+            def sha1(filename=filename):
+                if filename not in hashes:
+                    hashes[filename] = file_sha1(filename)
+                return hashes[filename]
+
+            output_dirs = dict((fmt, os.path.dirname(filename).replace(flac_dir, transcode_dirs[fmt]))
+                               for fmt in output_formats
+                               if not manifests[fmt].is_current(sources[filename], source_stat,
+                                                                needed_sample_rate, sha1))
+            if output_dirs:
+                # don't hash the source again if we already know its SHA1
+                known_sha1 = hashes.get(filename) or next(
+                    (known for known in (manifests[fmt].known_sha1(sources[filename], source_stat)
+                                         for fmt in output_formats) if known), None)
+                jobs.append((filename, output_dirs, probe.streams[filename], probe.resample_rate(filename),
+                             source_stat, known_sha1))
+        for fmt in output_formats:
+            manifests[fmt].prune(sources.values())
+            manifests[fmt].save()
+
         # create transcoding threads
         #
-        # Use Pool.map() rather than Pool.apply_async() as it will raise
-        # exceptions synchronously. (Don't want to waste any more time
-        # when a transcode breaks.)
+        # Use Pool.imap_unordered() rather than Pool.apply_async() as
+        # it will raise exceptions synchronously (don't want to waste
+        # any more time when a transcode breaks), while each file is
+        # recorded in the manifests as soon as it's done.
         #
-        # XXX: actually, use Pool.map_async() and then get() the result
-        # with a large timeout, as a workaround for a KeyboardInterrupt in
-        # Pool.join(). c.f.,
+        # XXX: get() each result with a large timeout, as a workaround
+        # for a KeyboardInterrupt in Pool.join(). c.f.,
         # http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool?rq=1
-        pool = multiprocessing.Pool(max_threads, initializer=pool_initializer)
-        try:
-            result = pool.map_async(pool_transcode, [
-                (filename, os.path.dirname(filename).replace(flac_dir, transcode_dir), output_format)
-                for filename in flac_files])
-            result.get(60 * 60 * 12)
-            pool.close()
-        except:
-            pool.terminate()
-            raise
-        finally:
-            pool.join()
+        if jobs:
+            pool = multiprocessing.Pool(max_threads, initializer=pool_initializer)
+            try:
+                results = pool.imap_unordered(pool_transcode_targets, jobs)
+                for _ in jobs:
+                    filename, source_stat, sha1, transcode_files = results.next(60 * 60 * 12)
+                    if sha1 is None:
+                        # changed while being transcoded, so it's redone next time
+                        continue
+                    for fmt, transcode_file in transcode_files.items():
+                        manifests[fmt].add(sources[filename], source_stat, sample_rates[filename],
+                                           sha1, transcode_file)
+                        manifests[fmt].save()
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
 
         # copy other files
         allowed_extensions = ['.cue', '.gif', '.jpeg', '.jpg', '.log', '.md5', '.nfo', '.pdf', '.png', '.sfv', '.txt']
         allowed_files = locate(flac_dir, ext_matcher(*allowed_extensions))
         for filename in allowed_files:
-            new_dir = os.path.dirname(filename).replace(flac_dir, transcode_dir)
-            if not os.path.exists(new_dir):
-                os.makedirs(new_dir)
-            shutil.copy(filename, new_dir)
+            for transcode_dir in [transcode_dirs[fmt] for fmt in output_formats]:
+                new_dir = os.path.dirname(filename).replace(flac_dir, transcode_dir)
+                if not os.path.exists(new_dir):
+                    os.makedirs(new_dir)
+                shutil.copy(filename, new_dir)
 
-        return transcode_dir
+        return transcode_dirs if multi else transcode_dirs[output_format]
 
     except:
-        # Cleanup.
+        # Cleanup, unless the completed files are kept for resuming.
         #
-        # ASSERT: transcode_dir was created by this function and does
+        # ASSERT: created_dirs were created by this function and do
         # not contain anything other than the transcoded files!
-        shutil.rmtree(transcode_dir)
+        if not resume:
+            for transcode_dir in created_dirs:
+                shutil.rmtree(transcode_dir)
         raise
@@ -1,10 +1,20 @@
 import os
 import time
+import queue
 import tempfile
 import functools
+import threading
+import collections
+import concurrent.futures
 from . import metafile
 
 
+class _Stopped(Exception):
+    '''
+    Raised to stop creating a torrent when another one has failed.
+    '''
+
+
 def rate_limit(interval):
     """
     Rate limiting decorator which allows the wrapped function to be
@@ -63,11 +73,112 @@ def make_torrent(path, passkey, output_dir=None):
     - `passkey`: Your tracker passkey.
     - `output_dir`: The directory where the torrent will be created. If unspecified, {} will be used.
     '''.format(tempfile.tempdir)
+    return _create_torrent(path, passkey, output_dir)[0]
+
+
+def _create_torrent(path, passkey, output_dir=None, hash_pool=None, workers=1, progress=None):
+    '''
+    Creates a torrent suitable for uploading to PTH, and returns its path
+    and the number of bytes hashed.
+    '''
     if output_dir is None:
         output_dir = tempfile.tempdir
 
     torrent_path = tempfile.mktemp(dir=output_dir, suffix='.torrent')
     torrent = metafile.Metafile(torrent_path)
+    torrent.hash_pool = hash_pool
     announce_url = 'https://please.passtheheadphones.me/{}/announce'.format(passkey)
-    torrent.create(path, [announce_url], private=True, callback=_add_source)
+    torrent.create(path, [announce_url], private=True, callback=_add_source, workers=workers, progress=progress)
+    return torrent_path, sum(entry.size for entry in torrent.inventory())
+
+
+def retarget_torrent(torrent_file, passkey, output_dir=None, data_path=None):
+    '''
+    Creates a torrent suitable for uploading to PTH from a torrent for the
+    same data on another tracker, without hashing the data again.
+
+    - `torrent_file`: The existing torrent.
+    - `passkey`: Your tracker passkey.
+    - `output_dir`: The directory where the torrent will be created. If unspecified, {} will be used.
+    - `data_path`: If given, a few pieces of this data are checked against the torrent first.
+    '''.format(tempfile.tempdir)
+    if output_dir is None:
+        output_dir = tempfile.tempdir
+
+    torrent_path = tempfile.mktemp(dir=output_dir, suffix='.torrent')
+    torrent = metafile.Metafile(torrent_path)
+    announce_url = 'https://please.passtheheadphones.me/{}/announce'.format(passkey)
+    torrent.retarget(metafile.checked_open(torrent_file), announce_url,
+                     {'source': 'PTH', 'private': 1}, datapath=data_path)
     return torrent_path
+
+
+def make_torrents(paths, passkey, output_dir=None, readers_per_device=1, hash_threads=None):
+    '''
+    Creates torrents for many releases at once, without letting releases
+    on the same disk compete for it.
+
+    Releases are grouped by device (`st_dev`); each device gets
+    `readers_per_device` sequential readers, and all of them share one
+    pool of `hash_threads` hashing threads (default: one per CPU).
+
+    Returns a list of torrent paths (in the order of `paths`) and a dict
+    mapping each device to its `bytes`, `seconds` and `rate` (bytes per
+    second). If creating any torrent fails, all readers stop as soon as
+    possible, and its exception is raised.
+    '''
+    paths = list(paths)
+    if not paths:
+        return [], {}
+    hash_threads = hash_threads or os.cpu_count() or 1
+
+    devices = collections.defaultdict(queue.Queue)
+    for idx, path in enumerate(paths):
+        devices[os.stat(path).st_dev].put(idx)
+
+    # Each reader keeps only its share of the hashing threads busy, so
+    # the pieces buffered in memory don't grow with the number of readers
+    readers_count = len(devices) * readers_per_device
+    reader_workers = max(1, hash_threads // readers_count)
+
+    torrent_paths = [None] * len(paths)
+    stats = dict((device, {'bytes': 0, 'seconds': 0.0, 'rate': 0.0}) for device in devices)
+    lock = threading.Lock()
+    failed = threading.Event()
+
+    def check_failed(done, total):
+        if failed.is_set():
+            raise _Stopped()
+
+    def reader(device):
+        while not failed.is_set():
+            try:
+                idx = devices[device].get_nowait()
+            except queue.Empty:
+                return
+            torrent_paths[idx], size = _create_torrent(paths[idx], passkey, output_dir, hash_pool, reader_workers,
+                                                       check_failed)
+            with lock:
+                stats[device]['bytes'] += size
+
+    with concurrent.futures.ThreadPoolExecutor(hash_threads) as hash_pool:
+        with concurrent.futures.ThreadPoolExecutor(readers_count) as readers:
+            started = time.time()
+            futures = dict((readers.submit(reader, device), device)
+                           for device in devices for _ in range(readers_per_device))
+            pending = set(futures)
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_EXCEPTION)
+                for future in done:
+                    if future.exception() is not None:
+                        # Stop the other readers, then raise the first error
+                        failed.set()
+                        concurrent.futures.wait(pending)
+                        future.result()
+                    stats[futures[future]]['seconds'] = time.time() - started
+
+    for device_stats in stats.values():
+        if device_stats['seconds']:
+            device_stats['rate'] = device_stats['bytes'] / device_stats['seconds']
+
+    return torrent_paths, stats